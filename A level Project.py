@@ -1,7 +1,13 @@
+import time
+STARTED = time.perf_counter()
 import pygame
 import random
 import os
 import sys
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pytmx
 
 # -- Global Constants
@@ -15,6 +21,7 @@ RED = (255, 0, 0)
 YELLOW = (255,255,0)
 PINK = (255,192,203)
 NIGHTBLUE = (34, 36, 64)
+COLOURKEY = (255, 0, 255)
 
 # -- Game settings
 if sys.platform == 'darwin':
@@ -25,6 +32,9 @@ else:
     HEIGHT = 640        #20*32
 FPS = 60
 GAMETITLE = 'A Level Project'
+DIRTY_RECTS = False     #only redraw and update the changed parts of the screen, also turned on with --dirty
+BENCH_FRAMES = 300      #frames per run of --bench-render
+BENCH_PAN = 4       #camera speed in pixels per frame for the busy benchmark scene
 
 BGCOLOUR = NIGHTBLUE
 
@@ -44,30 +54,167 @@ FRICTION = -0.15
 GRAVITY = 0.3
 KNOCKBACK = 15
 
+# -- Sprite settings
+PLAYER_SPRITES = ['images/player/idle', 'images/player/run', 'images/player/jump', 'images/player/fall', 'images/player/attack', 'images/player/hurt', 'images/player/death', 'images/player/air_attack']
+SLIME_SPRITES = ['images/mobs/slime/idle', 'images/mobs/slime/move', 'images/mobs/slime/attack', 'images/mobs/slime/death', 'images/mobs/slime/hurt']
+DEMON_SPRITES = ['images/mobs/demon/idle', 'images/mobs/demon/attack', 'images/mobs/demon/hurt', 'images/mobs/demon/death']
+DEMON_BERSERK_SPRITES = ['images/mobs/demon/berserk']
+KEY_SPRITES = ['images/items/key/spinning']
+PLAYER_WARMUP = [0, 1, 2, 3]        #idle, run, jump, fall
+SLIME_WARMUP = [0, 1]       #idle, move
+DEMON_WARMUP = [0]      #idle
+KEY_WARMUP = [0]        #spinning
+ENTITY_SPRITES = {'player': (PLAYER_SPRITES, 2, PLAYER_WARMUP), 'slime': (SLIME_SPRITES, 2, SLIME_WARMUP), 'demon': (DEMON_SPRITES, 2, DEMON_WARMUP), 'key': (KEY_SPRITES, 0.3, KEY_WARMUP)}
+ANIMATION_SETS = [(PLAYER_SPRITES, 2), (SLIME_SPRITES, 2), (DEMON_SPRITES, 2), (DEMON_BERSERK_SPRITES, 2), (KEY_SPRITES, 0.3)]
+ATLAS_DIR = 'images/atlas'
+ATLAS_SIZE = 4096
+CACHE_DIR = 'cache'
+MIRROR_AT_BLIT = False      #flip facing-left frames while drawing instead of caching mirrored copies
+PRELOAD_WORKERS = 4
+VARIANT_LIMIT = 256     #faded/tinted frames kept before the variant cache is cleared
+TEXT_CACHE_LIMIT = 256      #rendered lines of text kept, least recently used are dropped first
+
 # -- Map and Camera settings
 LEVEL = 0
+LEVELS = 4      #number of levels, including the start screen map
 CAMERALAG = 25
+MAP_CHUNK_TILES = 16        #map is drawn from square chunks of this many tiles
+MAP_CACHE_BUDGET = 32*1024*1024     #bytes of chunk surfaces kept per map
+MAP_EVICT_MARGIN = 1        #screens around the view that decoded tiles of infinite maps are kept for
 
 # -- Sprites Classes
 def collide_hit_rect(a, b):
     return a.hit_rect.colliderect(b.hit_rect)
 
 def load_sprites(paths, magnify):
+    return game.sprite_cache.get(paths, magnify)
+
+def load_mirrored_sprites(paths, magnify):
+    return game.sprite_cache.get_mirrored(paths, magnify)
+
+def load_animations(paths, magnify, warmup):
+    return AnimationSet(paths, magnify, warmup), AnimationSet(paths, magnify, [], True)
+
+def sprite_files(path):
+    return [os.path.join(path, i) for i in sorted(os.listdir(path)) if i.endswith('.png')]
+
+def read_sprites(path, magnify, cache_dir=CACHE_DIR):
+    #safe to run on a worker thread, nothing is converted to the display format
+    return [pytmx.util_pygame.load_image_file(i, magnify, cache_dir) for i in sprite_files(path)]
+
+def decode_sprites(paths, magnify):
     sprites = []
-    mirrored_sprites = []
     for path in paths:
-        temp_list = []
-        temp_list2 = []
-        for i in sorted(os.listdir(path)):
-            if i.endswith('.png'):
-                image = pygame.image.load(os.path.join(path, i)).convert_alpha()
+        temp_list = game.sprite_atlas.frames(path, magnify)
+        if temp_list is None:
+            temp_list = [game.surface_registry.normalise(image) for image in read_sprites(path, magnify)]
+        sprites.append(tuple(temp_list))
+    return tuple(sprites)
+
+def warmup_sprites(paths, magnify, warmup):
+    return [(paths[action], magnify) for action in warmup]
+
+def atlas_key(path, magnify):
+    return path + '@' + str(magnify)
+
+def newest_mtime(path):
+    return max([os.path.getmtime(path)] + [os.path.getmtime(i) for i in sprite_files(path)])
+
+def bake_atlases():
+    frames = []
+    mtimes = {}
+    for paths, magnify in ANIMATION_SETS:
+        for path in paths:
+            key = atlas_key(path, magnify)
+            mtimes[key] = newest_mtime(path)
+            for n, i in enumerate(sprite_files(path)):
+                image = pygame.image.load(i)
+                if not image.get_flags() & pygame.SRCALPHA:     #colorkeyed frames, no display to convert_alpha() with
+                    temp = pygame.Surface(image.get_size(), pygame.SRCALPHA)
+                    temp.blit(image, (0, 0))
+                    image = temp
                 size = tuple(int(magnify*x) for x in image.get_size())
-                image = pygame.transform.scale(image, size)
-                temp_list.append(image)
-                temp_list2.append(pygame.transform.flip(image, True, False))
-        sprites.append(temp_list)
-        mirrored_sprites.append(temp_list2)
-    return sprites, mirrored_sprites
+                frames.append((key, n, pygame.transform.scale(image, size)))
+    #shelf packing, tallest frames first
+    frames.sort(key=lambda i: i[2].get_height(), reverse=True)
+    index = {}
+    sheets = [[]]
+    x, y, shelf_height = 0, 0, 0
+    for key, n, image in frames:
+        w, h = image.get_size()
+        if x + w > ATLAS_SIZE:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        if y + h > ATLAS_SIZE:
+            sheets.append([])
+            x, y, shelf_height = 0, 0, 0
+        sheets[-1].append((image, x, y))
+        index.setdefault(key, []).append((n, [len(sheets)-1, x, y, w, h]))
+        x += w
+        shelf_height = max(shelf_height, h)
+    os.makedirs(ATLAS_DIR, exist_ok=True)
+    atlases = []
+    for number, sheet in enumerate(sheets):
+        height = max(y + image.get_height() for image, x, y in sheet)
+        surface = pygame.Surface((ATLAS_SIZE, height), pygame.SRCALPHA)
+        for image, x, y in sheet:
+            surface.blit(image, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+        name = 'atlas' + str(number) + '.png'
+        pygame.image.save(surface, os.path.join(ATLAS_DIR, name))
+        atlases.append(name)
+    index = {key: [rect for n, rect in sorted(value)] for key, value in index.items()}
+    with open(os.path.join(ATLAS_DIR, 'index.json'), 'w') as f:
+        json.dump({'atlases': atlases, 'frames': index, 'mtimes': mtimes}, f, separators=(',', ':'))
+    print('Baked', len(frames), 'frames into', len(atlases), 'atlases')
+
+def bench_render():
+    #time Game.draw with full redraws against dirty rects, on a still and a panning camera
+    game.difficulty = 0
+    game.change_difficulty()
+    game.variable_reset()
+    game.next_level()
+    game.mode = 'in game'
+    print('Render benchmark, level', game.level, BENCH_FRAMES, 'frames per run')
+    for scene in ['idle', 'busy']:
+        for dirty in [False, True]:
+            game.dirty_rects = dirty
+            game.level -= 1
+            game.next_level()
+            game.player.health = 10**6
+            random.seed(0)
+            pan = 0
+            pan_range = max(1, 2 * (game.camera.rect.width - WIDTH))
+            draw_time = 0
+            area = 0
+            for frame in range(BENCH_FRAMES):
+                game.update()
+                if scene == 'busy':
+                    pan = (pan + BENCH_PAN) % pan_range
+                    game.camera.x = game.camera.rect.x + min(pan, pan_range - pan)
+                start = time.perf_counter()
+                game.draw()
+                draw_time += time.perf_counter() - start
+                area += game.updated_area
+            string = scene + ' ' + ('dirty rects' if dirty else 'full redraw') + ': '
+            string += "{:.2f}".format(1000 * draw_time / BENCH_FRAMES) + ' ms per frame, '
+            string += "{:.0f}".format(100 * area / (BENCH_FRAMES * WIDTH * HEIGHT)) + '% of the screen updated'
+            print(string)
+
+def surface_bytes(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+def merge_rects(rects):
+    #clip to the screen and union overlapping rects, so no area is redrawn twice
+    screen = pygame.Rect(0, 0, WIDTH, HEIGHT)
+    merged = []
+    for rect in rects:
+        rect = rect.clip(screen)
+        if rect.width and rect.height:
+            i = rect.collidelist(merged)
+            while i != -1:
+                rect.union_ip(merged.pop(i))
+                i = rect.collidelist(merged)
+            merged.append(rect)
+    return merged
 
 def wall_collisions(sprite, direction):
     hits = pygame.sprite.spritecollide(sprite, game.wall_group, False, collide_hit_rect)
@@ -103,8 +250,7 @@ class Player(pygame.sprite.Sprite):
         self.groups = game.player_group
         pygame.sprite.Sprite.__init__(self, self.groups)
         self.game = game
-        paths = ['images/player/idle', 'images/player/run', 'images/player/jump', 'images/player/fall', 'images/player/attack', 'images/player/hurt', 'images/player/death', 'images/player/air_attack']
-        self.sprites, self.mirrored_sprites = load_sprites(paths, 2)
+        self.sprites, self.mirrored_sprites = load_animations(PLAYER_SPRITES, 2, PLAYER_WARMUP)
         self.current_action = 0
         '''
         Player actions:
@@ -369,7 +515,7 @@ class Player(pygame.sprite.Sprite):
         if self.health <= 0 and self.current_action != 6:
             self.current_action = 6
             self.current_sprite = -1
-        if self.pos.y > self.game.map.height + 2000:
+        if self.pos.y > self.game.map.rect.bottom + 2000:
             self.kill()
             self.game.game_over()
         self.animations()
@@ -382,8 +528,7 @@ class Slime(pygame.sprite.Sprite):
         self.groups = game.enemy_group, game.slime_group
         pygame.sprite.Sprite.__init__(self, self.groups)
         self.game = game
-        paths = ['images/mobs/slime/idle', 'images/mobs/slime/move', 'images/mobs/slime/attack', 'images/mobs/slime/death', 'images/mobs/slime/hurt']
-        self.sprites, self.mirrored_sprites = load_sprites(paths, 2)
+        self.sprites, self.mirrored_sprites = load_animations(SLIME_SPRITES, 2, SLIME_WARMUP)
         self.current_action = 0
         '''
         Slime actions:
@@ -534,7 +679,7 @@ class Slime(pygame.sprite.Sprite):
         if self.health <= 0 and self.current_action != 3:
             self.current_action = 3
             self.current_sprite = -1
-        if self.pos.y > self.game.map.height + 2000:
+        if self.pos.y > self.game.map.rect.bottom + 2000:
             self.kill()
         self.animations()
 
@@ -544,9 +689,8 @@ class Demon(pygame.sprite.Sprite):
         self.groups = game.enemy_group, game.demon_group
         pygame.sprite.Sprite.__init__(self, self.groups)
         self.game = game
-        paths = ['images/mobs/demon/idle', 'images/mobs/demon/attack', 'images/mobs/demon/hurt', 'images/mobs/demon/death']
-        self.sprites, self.mirrored_sprites = load_sprites(paths, 2)
-        self.berserk_sprites, self.mirrored_berserk_sprites = load_sprites(['images/mobs/demon/berserk'], 2)
+        self.sprites, self.mirrored_sprites = load_animations(DEMON_SPRITES, 2, DEMON_WARMUP)
+        self.berserk_sprites, self.mirrored_berserk_sprites = load_animations(DEMON_BERSERK_SPRITES, 2, [])
         self.current_action = 0
         '''
         Demon actions:
@@ -575,6 +719,8 @@ class Demon(pygame.sprite.Sprite):
         self.invincible = False
         self.berserking = False
         self.attack_dmg = 1
+        self.alpha = 255
+        self.tint = None
 
     def movements(self):
         now = pygame.time.get_ticks()
@@ -684,7 +830,7 @@ class Demon(pygame.sprite.Sprite):
                     last_enemy(self.hit_rect.center[0], self.hit_rect.center[1]-30, self.face_left)
                     self.kill()
                 self.image = sprites_list[self.current_action][self.current_sprite]
-                self.image.set_alpha(255*((16-self.current_sprite)/16))
+                self.alpha = int(255*((16-self.current_sprite)/16))
                 self.last_sprite_time = pygame.time.get_ticks()
 
     def update(self):
@@ -709,7 +855,7 @@ class Demon(pygame.sprite.Sprite):
         if self.health <= 0 and self.current_action != 3:
             self.current_action = 3
             self.current_sprite = -1
-        if self.pos.y > self.game.map.height + 2000:
+        if self.pos.y > self.game.map.rect.bottom + 2000:
             self.kill()
         self.animations()
         
@@ -719,8 +865,7 @@ class Key(pygame.sprite.Sprite):
         self.groups = game.item_group
         pygame.sprite.Sprite.__init__(self, self.groups)
         self.game = game
-        paths = ['images/items/key/spinning']
-        self.sprites, self.mirrored_sprites = load_sprites(paths, 0.3)
+        self.sprites, self.mirrored_sprites = load_animations(KEY_SPRITES, 0.3, KEY_WARMUP)
         self.current_action = 0
         '''
         Key actions:
@@ -830,8 +975,8 @@ class Door(pygame.sprite.Sprite):
         self.groups = game.all_sprites_group, game.door_group
         pygame.sprite.Sprite.__init__(self, self.groups)
         self.game = game
-        self.closed = pygame.transform.scale(pygame.image.load('images/door/closed.png'), (70,80))
-        self.opened = pygame.transform.scale(pygame.image.load('images/door/open.png'), (70,80))
+        self.closed = game.surface_registry.load('images/door/closed.png', (70,80))
+        self.opened = game.surface_registry.load('images/door/open.png', (70,80))
         self.image = self.closed
         self.rect = self.image.get_rect()
         self.hit_rect = self.rect
@@ -858,8 +1003,8 @@ class Treasure(pygame.sprite.Sprite):
         self.game = game
         image1 = 'images/treasure/type' + str(type) + 'closed.png'
         image2 = 'images/treasure/type' + str(type) + 'opened.png'
-        self.closed = pygame.transform.scale(pygame.image.load(image1), (30,36))
-        self.opened = pygame.transform.scale(pygame.image.load(image2), (30,36))
+        self.closed = game.surface_registry.load(image1, (30,36))
+        self.opened = game.surface_registry.load(image2, (30,36))
         self.image = self.closed
         self.rect = self.image.get_rect()
         self.hit_rect = self.rect
@@ -886,6 +1031,7 @@ class Melee_attack(pygame.sprite.Sprite):
         pygame.sprite.Sprite.__init__(self, self.groups)
         self.game = game
         self.image = pygame.Surface((w, h), pygame.SRCALPHA)
+        self.visible = self.game.show_hit_rect      #only drawn as a debug overlay
         if self.game.show_hit_rect:
             self.image.fill(RED)
         self.rect = self.image.get_rect()
@@ -918,35 +1064,486 @@ class Melee_attack(pygame.sprite.Sprite):
             if self.single_attack:
                 self.kill()
         
+#Animation set class
+class AnimationSet():
+    def __init__(self, paths, magnify, warmup, mirrored=False):
+        self.paths = paths
+        self.magnify = magnify
+        self.mirrored = mirrored
+        self.frames = {}
+        for action in warmup:
+            if action == warmup[0]:
+                self[action]
+            else:
+                game.defer(self.__getitem__, action)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, action):
+        #frames are only loaded the first time an action is entered
+        if action not in self.frames:
+            if self.mirrored:
+                self.frames[action] = load_mirrored_sprites([self.paths[action]], self.magnify)[0]
+            else:
+                self.frames[action] = load_sprites([self.paths[action]], self.magnify)[0]
+        return self.frames[action]
+
+    def __setitem__(self, action, frames):
+        self.frames[action] = frames
+
+#Surface registry class
+class SurfaceRegistry():
+    def __init__(self):
+        self.opaque = 0
+        self.colourkeyed = 0
+        self.alpha = 0
+        self.flagged = set()
+
+    def load(self, path, size=None):
+        image = pytmx.util_pygame.load_image_file(path, cache_dir=CACHE_DIR)
+        if size:
+            image = pygame.transform.scale(pytmx.util_pygame.to_rgba(image), size)
+        return self.normalise(image)
+
+    def normalise(self, image, colourkey=True):
+        #pick the fastest display format, like pytmx.util_pygame.smart_convert does for tiles
+        image = pytmx.util_pygame.to_rgba(image)
+        width, height = image.get_size()
+        opaque = pygame.mask.from_surface(image, 254).count()
+        if opaque == width * height:
+            self.opaque += 1
+            return image.convert()
+        visible = pygame.mask.from_surface(image, 0).count()
+        if colourkey and opaque == visible and not pygame.mask.from_threshold(image, COLOURKEY + (255,), (1, 1, 1, 1)).count():
+            #no partly transparent pixels, so a colourkey with RLE is enough
+            self.colourkeyed += 1
+            surface = pygame.Surface((width, height)).convert()
+            surface.fill(COLOURKEY)
+            surface.blit(image, (0, 0))
+            surface.set_colorkey(COLOURKEY, pygame.RLEACCEL)
+            return surface
+        self.alpha += 1
+        return image.convert_alpha()
+
+    def converted(self, image):
+        screen = pygame.display.get_surface()
+        if image.get_flags() & pygame.SRCALPHA:
+            return image.get_bitsize() == 32 and image.get_masks()[:3] == screen.get_masks()[:3]
+        return image.get_bitsize() == screen.get_bitsize() and image.get_masks() == screen.get_masks()
+
+    def check(self, image, source):
+        if not self.converted(image) and source not in self.flagged:
+            self.flagged.add(source)
+            print('Unconverted surface reaching Game.draw():', source, image)
+
+    def stats(self):
+        return 'Surfaces: ' + str(self.opaque) + ' opaque ' + str(self.colourkeyed) + ' colourkey ' + str(self.alpha) + ' alpha'
+
+#Sprite atlas class
+class SpriteAtlas():
+    def __init__(self, directory):
+        self.directory = directory
+        self.atlases = []
+        self.index = {}
+        self.mtimes = {}
+        self.surfaces = {}
+        path = os.path.join(directory, 'index.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.atlases = data['atlases']
+            self.index = data['frames']
+            self.mtimes = data['mtimes']
+
+    def surface(self, number):
+        if number not in self.surfaces:
+            image = pytmx.util_pygame.load_image_file(os.path.join(self.directory, self.atlases[number]), cache_dir=CACHE_DIR)
+            self.surfaces[number] = game.surface_registry.normalise(image, False)
+        return self.surfaces[number]
+
+    def has(self, path, magnify):
+        key = atlas_key(path, magnify)
+        return key in self.index and self.mtimes[key] >= newest_mtime(path)
+
+    def frames(self, path, magnify):
+        if not self.has(path, magnify):
+            return None
+        key = atlas_key(path, magnify)
+        return [self.surface(number).subsurface((x, y, w, h)) for number, x, y, w, h in self.index[key]]
+
+#Sprite cache class
+class SpriteCache():
+    def __init__(self):
+        self.frames = {}
+        self.mirrored_frames = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.mirrored = 0
+        self.blit_flips = 0
+        self.variants = {}
+        self.preloaded = 0
+        self.preload_jobs = []
+        self.preload_time = 0
+        self.serial_reads = 0
+        self.parallel_reads = 0
+
+    def store(self, key, sprites):
+        self.misses += 1
+        for frames in sprites:
+            for frame in frames:
+                self.bytes += surface_bytes(frame)
+        self.frames[key] = sprites
+
+    def get(self, paths, magnify):
+        key = (tuple(paths), magnify)
+        if key in self.frames:
+            self.hits += 1
+        else:
+            self.store(key, decode_sprites(paths, magnify))
+        return self.frames[key]
+
+    def read_all(self, jobs, workers, cache_dir=CACHE_DIR):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(lambda job: read_sprites(job[0], job[1], cache_dir), jobs))
+        return results, time.perf_counter() - start
+
+    def preload(self, jobs):
+        #decode (directory, magnify) jobs on a thread pool, then convert on the main thread
+        jobs = [job for job in dict.fromkeys(jobs) if ((job[0],), job[1]) not in self.frames and not game.sprite_atlas.has(*job)]
+        if not jobs:
+            return
+        start = time.perf_counter()
+        results = self.read_all(jobs, PRELOAD_WORKERS)[0]
+        for (path, magnify), images in zip(jobs, results):
+            self.store(((path,), magnify), (tuple(game.surface_registry.normalise(image) for image in images),))
+        self.preloaded += len(jobs)
+        self.preload_jobs += jobs
+        self.preload_time += time.perf_counter() - start
+
+    def compare_reads(self):
+        #decode the preloaded PNGs again, skipping the pixel cache, with one worker and with the pool
+        self.serial_reads = self.read_all(self.preload_jobs, 1, None)[1]
+        self.parallel_reads = self.read_all(self.preload_jobs, PRELOAD_WORKERS, None)[1]
+
+    def preload_stats(self):
+        string = 'Preloaded ' + str(self.preloaded) + ' dirs: ' + str(int(self.preload_time*1000)) + ' ms'
+        if self.serial_reads:
+            string += '\nPNG decodes: ' + str(int(self.serial_reads*1000)) + ' ms with 1 worker, '
+            string += str(int(self.parallel_reads*1000)) + ' ms with ' + str(PRELOAD_WORKERS)
+        return string
+
+    def get_mirrored(self, paths, magnify):
+        if MIRROR_AT_BLIT:
+            return self.get(paths, magnify)
+        key = (tuple(paths), magnify)
+        if key not in self.mirrored_frames:
+            mirrored_sprites = []
+            for frames in self.get(paths, magnify):
+                mirrored_sprites.append(tuple(pygame.transform.flip(frame, True, False) for frame in frames))
+                for frame in frames:
+                    self.bytes += surface_bytes(frame)
+                self.mirrored += len(frames)
+            self.mirrored_frames[key] = tuple(mirrored_sprites)
+        return self.mirrored_frames[key]
+
+    def variant(self, image, alpha, tint):
+        #shared frames are never modified, faded and tinted copies are cached instead
+        key = (image, alpha, tint)
+        if key not in self.variants:
+            if len(self.variants) >= VARIANT_LIMIT:
+                self.variants.clear()
+            if image.get_colorkey():
+                surface = image.convert_alpha()     #tinting would recolour the colourkey
+            else:
+                surface = image.copy()
+            if tint:
+                surface.fill(tint, special_flags=pygame.BLEND_RGB_MULT)
+            if alpha < 255:
+                surface.set_alpha(alpha)
+            self.variants[key] = surface
+        return self.variants[key]
+
+    def flip(self, image):
+        self.blit_flips += 1
+        return pygame.transform.flip(image, True, False)
+
+    def stats(self):
+        string = 'Sprite cache: ' + str(self.hits) + ' hits ' + str(self.misses) + ' misses ' + str(self.bytes//1024) + ' KB'
+        string += '\nMirrored frames: ' + str(self.mirrored) + ' Blit flips: ' + str(self.blit_flips)
+        string += '\nFaded/tinted variants: ' + str(len(self.variants))
+        string += '\n' + self.preload_stats()
+        return string
+
+#Text cache class
+class TextCache():
+    def __init__(self, limit):
+        self.limit = limit
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, colour):
+        #most HUD and menu lines are the same every frame
+        key = (font, text, colour)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+        else:
+            self.misses += 1
+            surface = font.render(text, False, colour)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.limit:
+                self.surfaces.popitem(False)
+        return surface
+
+    def stats(self):
+        looks = self.hits + self.misses
+        string = 'Text cache: ' + str(len(self.surfaces)) + ' lines '
+        string += "{:.0f}".format(100 * self.hits / looks if looks else 0) + '% hits'
+        return string
+
 # -- Map and Camera
 
 #Map class
 class TiledMap:
     def __init__(self, filename):
-        tm = pytmx.load_pygame(filename, pixelalpha=True)
-        self.width = tm.width * tm.tilewidth
-        self.height = tm.height * tm.tileheight
+        #parse, and read the tileset images without converting them, so this is safe on a worker thread
+        tm = pytmx.TiledMap(filename, cache_dir=CACHE_DIR)
         self.tmxdata = tm
-
-    def render(self, surface):
-        ti = self.tmxdata.get_tile_image_by_gid
-        for layer in self.tmxdata.visible_layers:
-            if isinstance(layer, pytmx.TiledTileLayer):
-                for x, y, gid, in layer:
-                    tile = ti(gid)
-                    if tile:
-                        surface.blit(tile, (x * self.tmxdata.tilewidth, y * self.tmxdata.tileheight))
-
-    def make_map(self):
-        temp_surface = pygame.Surface((self.width, self.height))
-        self.render(temp_surface)
-        return temp_surface
+        self.rect = self.bounds()
+        self.width = self.rect.width
+        self.height = self.rect.height
+        tilesets = [ts for ts in tm.tilesets if ts.source is not None]
+        with ThreadPoolExecutor(PRELOAD_WORKERS) as pool:
+            self.opened = dict(pool.map(self.open_tileset, tilesets))
+
+    def bounds(self):
+        #infinite maps can have chunks outside their declared size, even at negative coordinates
+        tm = self.tmxdata
+        rect = pygame.Rect(0, 0, tm.width, tm.height)
+        if tm.infinite:
+            chunks = []
+            for layer in tm.layers:
+                data = getattr(layer, 'data', None)
+                if isinstance(data, pytmx.ChunkedLayerData):
+                    chunks += [pygame.Rect(cx * data.chunk_width, cy * data.chunk_height, data.chunk_width, data.chunk_height) for cx, cy in data.keys()]
+            if chunks:
+                rect = chunks[0].unionall(chunks)
+        return pygame.Rect(rect.x * tm.tilewidth, rect.y * tm.tileheight, rect.width * tm.tilewidth, rect.height * tm.tileheight)
+
+    def open_tileset(self, ts):
+        path = os.path.join(os.path.dirname(self.tmxdata.filename), ts.source)
+        colorkey = getattr(ts, 'trans', None)
+        return path, pytmx.util_pygame.pygame_image_loader(path, colorkey, tileset=ts, cache_dir=CACHE_DIR)
+
+    def image_loader(self, filename, colorkey, **kwargs):
+        #tileset images read in __init__ are used as they are
+        if filename in self.opened:
+            return self.opened.pop(filename)
+        return pytmx.util_pygame.pygame_image_loader(filename, colorkey, **kwargs)
+
+    def load_images(self):
+        #tiles are cut out and converted to the display format on the main thread
+        self.tmxdata.image_loader = self.image_loader
+        self.tmxdata.reload_images()
+        self.opened = {}
+
+    def collision_rects(self):
+        #tile layers with a collision property are solid wherever they have a tile
+        rects = []
+        for i, layer in enumerate(self.tmxdata.layers):
+            if isinstance(layer, pytmx.TiledTileLayer) and layer.properties.get('collision'):
+                rects += pytmx.util_pygame.build_rects(self.tmxdata, i)
+        return rects
+
+    def stats(self):
+        string = ''
+        for name, times in self.tmxdata.tileset_load_times.items():
+            string += '\nTileset ' + name + ': ' + "{:.1f}".format(sum(times)*1000) + ' ms'
+        return string[1:]
         
+#Map renderer class
+class MapRenderer():
+    def __init__(self, tiled_map, chunk_tiles=MAP_CHUNK_TILES, budget=MAP_CACHE_BUDGET):
+        self.map = tiled_map
+        self.tmxdata = tiled_map.tmxdata
+        self.chunk_tiles = chunk_tiles
+        self.chunk_width = chunk_tiles * self.tmxdata.tilewidth
+        self.chunk_height = chunk_tiles * self.tmxdata.tileheight
+        self.budget = budget
+        self.chunks = OrderedDict()     #least recently drawn first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.render_time = 0
+        self.view_chunk = None
+
+    def render_chunk(self, cx, cy):
+        start = time.perf_counter()
+        tmx = self.tmxdata
+        x, y = cx * self.chunk_tiles, cy * self.chunk_tiles
+        w = min(self.chunk_tiles, self.map.rect.right // tmx.tilewidth - x)
+        h = min(self.chunk_tiles, self.map.rect.bottom // tmx.tileheight - y)
+        surface = pygame.Surface((w * tmx.tilewidth, h * tmx.tileheight))
+        offset = (-x * tmx.tilewidth, -y * tmx.tileheight)
+        for layer in tmx.visible_tile_layers:
+            surface.blits(tmx.get_tile_blits_in_rect(layer, (x, y, w, h), offset), False)
+        self.renders += 1
+        self.render_time += time.perf_counter() - start
+        return surface
+
+    def store(self, key, surface):
+        self.chunks[key] = surface
+        self.bytes += surface.get_pitch() * surface.get_height()
+        while self.bytes > self.budget and len(self.chunks) > 1:
+            old = self.chunks.popitem(False)[1]
+            self.bytes -= old.get_pitch() * old.get_height()
+
+    def chunk(self, cx, cy):
+        key = (cx, cy)
+        surface = self.chunks.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+        else:
+            self.misses += 1
+            surface = self.render_chunk(cx, cy)
+            self.store(key, surface)
+        return surface
+
+    def chunk_range(self, left, top, width, height):
+        #chunks overlapping an area of the map, in pixels
+        bounds = self.map.rect
+        right, bottom = min(left + width, bounds.right), min(top + height, bounds.bottom)
+        left, top = max(left, bounds.left), max(top, bounds.top)
+        columns = range(left // self.chunk_width, (right - 1) // self.chunk_width + 1)
+        rows = range(top // self.chunk_height, (bottom - 1) // self.chunk_height + 1)
+        return [(cx, cy) for cy in rows for cx in columns]
+
+    def draw(self, surface, left, top, area=None):
+        #left, top is the map position at the top left of the surface, area limits drawing to part of it
+        if area is None:
+            area = surface.get_rect()
+            self.evict(left, top)
+        blits = []
+        for cx, cy in self.chunk_range(left + area.x, top + area.y, area.width, area.height):
+            blits.append((self.chunk(cx, cy), (cx * self.chunk_width - left, cy * self.chunk_height - top)))
+        surface.blits(blits, False)
+
+    def evict(self, left, top):
+        #decoded tiles of infinite maps far from the view are dropped, checked when the view enters another chunk
+        tmx = self.tmxdata
+        view_chunk = (left // self.chunk_width, top // self.chunk_height)
+        if tmx.infinite and view_chunk != self.view_chunk:
+            self.view_chunk = view_chunk
+            keep = pygame.Rect(left, top, WIDTH, HEIGHT).inflate(WIDTH * MAP_EVICT_MARGIN * 2, HEIGHT * MAP_EVICT_MARGIN * 2)
+            tmx.evict_chunks((keep.x // tmx.tilewidth, keep.y // tmx.tileheight, keep.width // tmx.tilewidth + 1, keep.height // tmx.tileheight + 1))
+
+    def warm(self):
+        #render the chunks around the player spawn before the level starts
+        for tile_object in self.tmxdata.objects:
+            if tile_object.name == 'player':
+                for key in self.chunk_range(int(tile_object.x) - WIDTH, int(tile_object.y) - HEIGHT, WIDTH*2, HEIGHT*2):
+                    if key not in self.chunks:
+                        self.store(key, self.render_chunk(*key))
+        return self
+
+    def stats(self):
+        looks = self.hits + self.misses
+        string = 'Map chunks: ' + str(len(self.chunks)) + ' (' + str(self.bytes//1024) + ' KB) '
+        string += "{:.0f}".format(100 * self.hits / looks if looks else 0) + '% hits'
+        string += '\nChunk render: ' + "{:.2f}".format(1000 * self.render_time / self.renders if self.renders else 0) + ' ms avg'
+        return string
+
+#Startup trace class
+class StartupTrace():
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.steps = []
+        self.done = False
+
+    def mark(self, label):
+        if not self.done:
+            now = time.perf_counter()
+            self.steps.append((label, (now - self.last)*1000))
+            self.last = now
+
+    def finish(self):
+        if not self.done:
+            self.mark('first frame')
+            self.done = True
+            if '--trace' in sys.argv:
+                print(self.report())
+                game.sprite_cache.compare_reads()       #after the first frame, so it is not traced
+                print(game.sprite_cache.preload_stats())
+
+    def time_to_first_frame(self):
+        return (self.last - self.start)*1000
+
+    def report(self):
+        string = 'Startup trace:'
+        for label, ms in self.steps:
+            string += '\n  ' + label + ': ' + "{:.1f}".format(ms) + ' ms'
+        string += '\nTime to first frame: ' + "{:.1f}".format(self.time_to_first_frame()) + ' ms'
+        return string
+
+#Level prefetcher class
+class LevelPrefetcher():
+    def __init__(self):
+        self.levels = {}
+        self.renderers = {}
+        self.threads = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, level):
+        self.levels[level] = TiledMap('maps/map'+str(level)+'.tmx')
+
+    def start(self, level):
+        #parse the next level and read its tilesets while this one is played
+        self.threads = {i: thread for i, thread in self.threads.items() if thread.is_alive()}
+        if level >= LEVELS or level in self.levels or level in self.threads:
+            return
+        self.threads[level] = threading.Thread(target=self.load, args=(level,), daemon=True)
+        self.threads[level].start()
+
+    def take(self, level):
+        thread = self.threads.pop(level, None)
+        if level in self.levels:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if thread:
+                thread.join()
+            if level not in self.levels:        #no prefetch, or it failed
+                self.load(level)
+        if level not in self.renderers:
+            #SDL surfaces are only converted and drawn on the main thread
+            self.levels[level].load_images()
+            self.renderers[level] = MapRenderer(self.levels[level]).warm()
+        #keep the current level around for restarts, and the next one if it is already loaded
+        self.levels = {i: self.levels[i] for i in (level, level + 1) if i in self.levels}
+        self.renderers = {level: self.renderers[level]}
+        return self.levels[level], self.renderers[level]
+
+    def join(self):
+        for thread in self.threads.values():
+            thread.join()
+        self.threads = {}
+
+    def stats(self):
+        return 'Level prefetch: ' + str(self.hits) + ' hits ' + str(self.misses) + ' misses'
+
 #Camera class
 class Camera():
-    def __init__(self, width, height, x, y):
-        self.width = width
-        self.height = height
+    def __init__(self, rect, x, y):
+        self.rect = rect        #map bounds in pixels
         self.x = int(x)
         self.y = int(y)
 
@@ -956,26 +1553,48 @@ class Camera():
     def apply_rect(self, rect):
         return rect.move(-self.x, -self.y)
 
+    def view(self):
+        return pygame.Rect(self.x, self.y, WIDTH, HEIGHT)
+
     def update(self, target):
         self.x += (target.rect.x - self.x + target.rect.width // 2 - WIDTH//2)//CAMERALAG
         self.y += (target.rect.y - self.y + target.rect.height // 2 - HEIGHT//2)//CAMERALAG
 
-        self.x = max(0, self.x)
-        self.y = max(0, self.y)
-        self.x = min(self.width - WIDTH, self.x)
-        self.y = min(self.height - HEIGHT, self.y)
+        self.x = max(self.rect.left, self.x)
+        self.y = max(self.rect.top, self.y)
+        self.x = min(self.rect.right - WIDTH, self.x)
+        self.y = min(self.rect.bottom - HEIGHT, self.y)
 
 
 # -- Main Game Class
 class Game():
     def __init__(self):
+        self.trace = StartupTrace(STARTED)
+        self.trace.mark('imports')
         pygame.init()
+        self.trace.mark('pygame init')
         size = (WIDTH, HEIGHT)
         self.screen = pygame.display.set_mode(size)
         pygame.display.set_caption(GAMETITLE)
         self.clock = pygame.time.Clock()
         pygame.key.set_repeat(100, 50)
+        self.trace.mark('display')
         self.myfont = pygame.font.Font('fonts/m5x7.ttf', 40)
+        self.trace.mark('font')
+        self.deferring = False
+        self.deferred = []
+        self.surface_registry = SurfaceRegistry()
+        self.sprite_atlas = SpriteAtlas(ATLAS_DIR)
+        self.sprite_cache = SpriteCache()
+        self.text_cache = TextCache(TEXT_CACHE_LIMIT)
+        self.prefetcher = LevelPrefetcher()
+        self.sprites_drawn = 0
+        self.sprites_culled = 0
+        self.dirty_rects = DIRTY_RECTS or '--dirty' in sys.argv
+        self.frame = []
+        self.dirty_frame = False
+        self.last_frame = None
+        self.updated_area = 0
         self.tools_reset()
         self.start_time = pygame.time.get_ticks()
 
@@ -997,6 +1616,7 @@ class Game():
         self.show_grid = False
         self.show_stats = False
         self.show_hit_rect = False
+        self.check_surfaces = False
 
     def new_game(self):
         self.variable_reset()
@@ -1017,19 +1637,48 @@ class Game():
         self.times[self.level] = time
         self.level += 1
         self.start_time = pygame.time.get_ticks()
+        if self.level < LEVELS:
+            self.load_assets(self.level, ['player', 'key'])
         self.load_items()
-        if self.level < 4:  #number of levels
+        if self.level < LEVELS:
             self.load_map(self.level)
         else:
             self.game_complete()
 
+    def load_assets(self, level, names):
+        #the map is parsed on the prefetch thread while sprites decode on the pool
+        self.prefetcher.start(level)
+        jobs = []
+        for name in names:
+            if name in ENTITY_SPRITES:
+                paths, magnify, warmup = ENTITY_SPRITES[name]
+                if self.deferring:
+                    warmup = warmup[:1]
+                jobs += warmup_sprites(paths, magnify, warmup)
+        self.sprite_cache.preload(jobs)
+        self.trace.mark('assets')
+
+    def defer(self, function, *args):
+        #work the start screen does not need waits until it has been drawn
+        if self.deferring:
+            self.deferred.append((function, args))
+        else:
+            function(*args)
+
+    def run_deferred(self):
+        if self.deferred:
+            function, args = self.deferred.pop(0)
+            function(*args)
+
     def load_items(self):
         self.key = Key(self, -50, -50, True, False)
 
     def load_map(self, level):
-        self.map = TiledMap('maps/map'+str(level)+'.tmx')
-        self.map_img = self.map.make_map()
-        self.map_rect = self.map_img.get_rect()
+        self.map, self.map_renderer = self.prefetcher.take(level)
+        self.trace.mark('map ' + str(level))
+        self.load_assets(level, set(tile_object.name for tile_object in self.map.tmxdata.objects))
+        for rect in self.map.collision_rects():
+            Wall(self, rect.x, rect.y, rect.width, rect.height)
         for tile_object in self.map.tmxdata.objects:
             if tile_object.name == 'player':
                 self.player = Player(self, tile_object.x, tile_object.y, self.player_health, self.player_dmg)
@@ -1047,7 +1696,10 @@ class Game():
                 Door(self, tile_object.x, tile_object.y)
             if tile_object.name == 'treasure':
                 Treasure(self, tile_object.x, tile_object.y, level)
-        self.camera = Camera(self.map.width, self.map.height, self.player.pos.x, self.player.pos.y)
+        self.camera = Camera(self.map.rect, self.player.pos.x, self.player.pos.y)
+        self.last_frame = None
+        self.trace.mark('entities')
+        self.defer(self.prefetcher.start, level + 1)
 
     def game_loop(self):
         self.done = False
@@ -1057,6 +1709,7 @@ class Game():
             self.events()
             self.update()
             self.draw()
+            self.run_deferred()
             
     def wait_loop(self):
         self.wait = True
@@ -1076,6 +1729,7 @@ class Game():
                 self.clock.tick(FPS)
                 self.events()
                 self.draw_menu()
+                self.run_deferred()
             self.new_game()
         elif self.mode == 'end screen':
             while self.wait:
@@ -1098,6 +1752,10 @@ class Game():
                     self.show_stats = not self.show_stats
                 if event.key == pygame.K_3:
                     self.show_hit_rect = not self.show_hit_rect
+                if event.key == pygame.K_4:
+                    self.check_surfaces = not self.check_surfaces
+                if event.key == pygame.K_5:
+                    self.dirty_rects = not self.dirty_rects
                 if self.mode == 'in game':
                     if event.key == pygame.K_t:
                         self.player.items.append('key')
@@ -1154,9 +1812,16 @@ class Game():
         textlist = texts.split('\n')
         counter = 0
         for line in textlist:
-            self.screen.blit(font.render(line, False, colour), (x, y + (y_intervals*counter)))
+            self.queue((line, colour), self.text_cache.render(font, line, colour), (x, y + (y_intervals*counter)))
             counter += 1
 
+    def queue(self, key, image, pos):
+        #everything drawn over the map is kept for the next frame to compare against
+        rect = image.get_rect(topleft=pos)
+        self.frame.append((key, image, rect))
+        if not self.dirty_frame:
+            self.screen.blit(image, rect)
+
     def draw_texts(self):
         offset = 768-HEIGHT
         now = pygame.time.get_ticks()
@@ -1189,6 +1854,14 @@ class Game():
             string += '\nPlayer Dmg: ' + str(self.player.attack_dmg)
             string += '\nFPS: ' + "{:.2f}".format(self.clock.get_fps())
             string += '\nItems: ' + str(self.player.items)
+            string += '\n' + self.sprite_cache.stats()
+            string += '\n' + self.text_cache.stats()
+            string += '\n' + self.prefetcher.stats()
+            string += '\n' + self.map.stats()
+            string += '\n' + self.map_renderer.stats()
+            string += '\nSprites: ' + str(self.sprites_drawn) + ' drawn ' + str(self.sprites_culled) + ' culled'
+            string += '\n' + self.surface_registry.stats()
+            string += '\nTime to first frame: ' + "{:.0f}".format(self.trace.time_to_first_frame()) + ' ms'
             self.blit_texts(string, WHITE, WIDTH-416, 64, 32, self.myfont)
         if self.mode == 'pause':
             self.dim_screen()
@@ -1221,17 +1894,76 @@ Press m to quit'''
             self.blit_texts("{:.0f}".format(self.times[3]//60) + ' minutes ' + "{:.2f}".format(self.times[3]%60) + ' seconds', WHITE, 480, 480-offset, 32, self.myfont)
             self.blit_texts(str(self.secrets_found)+'/3', WHITE, 480, 512-offset, 32, self.myfont)
 
+    def sprite_image(self, sprite):
+        image = sprite.image
+        alpha = getattr(sprite, 'alpha', 255)
+        tint = getattr(sprite, 'tint', None)
+        if alpha < 255 or tint:
+            image = self.sprite_cache.variant(image, alpha, tint)
+        if MIRROR_AT_BLIT and getattr(sprite, 'face_left', False):
+            image = self.sprite_cache.flip(image)
+        if self.check_surfaces:
+            self.surface_registry.check(image, sprite.__class__.__name__)
+        return image
+
+    def draw_sprites(self, sprites, view):
+        #one blits call per group, skipping hidden and off screen sprites
+        blits = []
+        for i in sprites:
+            if getattr(i, 'visible', True) and view.colliderect(i.rect):
+                image = self.sprite_image(i)
+                rect = i.rect.move(-view.x, -view.y)
+                self.frame.append((image, image, rect))
+                blits.append((image, rect))
+            else:
+                self.sprites_culled += 1
+        self.sprites_drawn += len(blits)
+        if not self.dirty_frame:
+            self.screen.blits(blits, False)
+
+    def redraw_dirty(self, last):
+        #scroll what is already on screen by the camera move, then repaint only what differs from the last frame
+        x, y, entries = last
+        dx, dy = self.camera.x - x, self.camera.y - y
+        dirty = []
+        if dx or dy:
+            self.screen.scroll(-dx, -dy)
+            if dx:
+                dirty.append(pygame.Rect(WIDTH - dx if dx > 0 else 0, 0, abs(dx), HEIGHT))
+            if dy:
+                dirty.append(pygame.Rect(0, HEIGHT - dy if dy > 0 else 0, WIDTH, abs(dy)))
+        old = set((key, tuple(rect.move(-dx, -dy))) for key, image, rect in entries)
+        new = set((key, tuple(rect)) for key, image, rect in self.frame)
+        dirty = merge_rects(dirty + [pygame.Rect(rect) for key, rect in old ^ new])
+        for area in dirty:
+            self.screen.set_clip(area)
+            self.map_renderer.draw(self.screen, self.camera.x, self.camera.y, area)
+            self.screen.blits([(image, rect) for key, image, rect in self.frame if area.colliderect(rect)], False)
+        self.screen.set_clip(None)
+        if dx or dy:
+            return [self.screen.get_rect()]
+        return dirty
+
     def draw(self):
-        self.screen.blit(self.map_img, self.camera.apply_rect(self.map_rect))
+        #dirty rects are only used in game with no debug overlays, anything else is redrawn in full
+        view = self.camera.view()
+        clean = self.dirty_rects and self.mode == 'in game' and not (self.show_grid or self.show_stats or self.show_hit_rect or self.check_surfaces)
+        last = self.last_frame
+        self.dirty_frame = clean and last is not None and abs(view.x - last[0]) < WIDTH and abs(view.y - last[1]) < HEIGHT
+        self.frame = []
+        if not self.dirty_frame:
+            self.map_renderer.draw(self.screen, self.camera.x, self.camera.y)
+        if self.check_surfaces:
+            for chunk in self.map_renderer.chunks.values():
+                self.surface_registry.check(chunk, 'map')
         if self.show_grid:
             self.show_grid_lines()
-        for i in self.all_sprites_group:
-            self.screen.blit(i.image, self.camera.apply(i))
-        for i in self.enemy_group:
-            self.screen.blit(i.image, self.camera.apply(i))
-        self.screen.blit(self.player.image, self.camera.apply(self.player))
-        for i in self.item_group:
-            self.screen.blit(i.image, self.camera.apply(i))
+        self.sprites_drawn = 0
+        self.sprites_culled = 0
+        self.draw_sprites(self.all_sprites_group, view)
+        self.draw_sprites(self.enemy_group, view)
+        self.draw_sprites([self.player], view)
+        self.draw_sprites(self.item_group, view)
         if self.show_hit_rect:
             pygame.draw.rect(self.screen, WHITE, self.camera.apply_rect(self.player.hit_rect), 2)
             for i in self.enemy_group:
@@ -1242,10 +1974,18 @@ Press m to quit'''
         for i in self.player.items:
             if i == 'key':
                 self.key.animations()
-                self.screen.blit(self.key.image, (96+num,192))
+                image = self.sprite_image(self.key)
+                self.queue(image, image, (96+num,192))
             num += 32
         self.draw_texts()
-        pygame.display.flip()
+        if self.dirty_frame:
+            rects = self.redraw_dirty(last)
+            pygame.display.update(rects)
+            self.updated_area = sum(rect.width * rect.height for rect in rects)
+        else:
+            pygame.display.flip()
+            self.updated_area = WIDTH * HEIGHT
+        self.last_frame = (view.x, view.y, self.frame) if clean else None
 
     def show_grid_lines(self):
         for x in range(0, WIDTH, TILESIZE):
@@ -1265,7 +2005,9 @@ Press m to quit'''
         self.player_health = HEALTH
         self.player_dmg = 1
         self.times = [0,0,0,0]
+        self.deferring = True
         self.next_level()
+        self.deferring = False
         self.mode = 'home screen'
         self.wait_loop()
 
@@ -1287,8 +2029,10 @@ Press m to quit'''
             self.difficulty_colour = RED
 
     def draw_menu(self):
+        self.frame = []
+        self.dirty_frame = False
         displacement = HEIGHT - self.map.height
-        self.screen.blit(self.map_img, (0,0 + displacement))
+        self.map_renderer.draw(self.screen, 0, -displacement)
         string = 'Use left and right arrow key to choose game difficulty\nDifficulty:\nPress z to start'
         self.blit_texts(string, WHITE, 128, 128 + displacement, 64, self.myfont)
         self.change_difficulty()
@@ -1308,9 +2052,10 @@ and enter next stage
         self.player.animations()
         for i in self.enemy_group:
             i.animations()
-            self.screen.blit(i.image, (710,660 + displacement))
-        self.screen.blit(self.player.image, (410,637 + displacement))
+            self.screen.blit(self.sprite_image(i), (710,660 + displacement))
+        self.screen.blit(self.sprite_image(self.player), (410,637 + displacement))
         pygame.display.flip()
+        self.trace.finish()
 
     def game_over(self):
         self.done = True
@@ -1326,11 +2071,19 @@ and enter next stage
         self.done = True
             
     def exit_game(self):
+        self.prefetcher.join()      #a prefetch may still be making surfaces
         pygame.quit()
         sys.exit()
 
 
 ### -- Game Loop
+if '--bake' in sys.argv:
+    bake_atlases()
+    sys.exit()
+if '--bench-render' in sys.argv:
+    game = Game()
+    bench_render()
+    sys.exit()
 run = True
 game = Game()
 game.home_screen()
@@ -0,0 +1,181 @@
+#Benchmarks for the map loading code in pytmx
+#run with: python benchmarks.py [size]
+import array
+import base64
+import random
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from itertools import product
+from xml.etree import ElementTree
+
+import pytmx
+
+# -- Benchmark settings
+MAP_SIZE = 1000
+UNIQUE_TILES = 64
+REPEATS = 3
+STREAM_MAP_MB = 50
+INDEX_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maps', 'map3.tmx')
+
+# -- Synthetic maps
+def make_layer_payload(size, unique, encoding):
+    rng = random.Random(size)
+    flips = [0, pytmx.pytmx.GID_TRANS_FLIPX, pytmx.pytmx.GID_TRANS_FLIPY]
+    gids = [rng.randint(1, unique) | rng.choice(flips) for i in range(size*size)]
+    if encoding == 'csv':
+        rows = [','.join(map(str, gids[y*size:(y+1)*size])) for y in range(size)]
+        return '<data encoding="csv">\n{0}\n</data>'.format(',\n'.join(rows))
+    data = array.array(pytmx.pytmx.gid_typecode, gids)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    data = data.tobytes()
+    if encoding == 'zlib':
+        data = zlib.compress(data)
+        return '<data encoding="base64" compression="zlib">{0}</data>'.format(base64.b64encode(data).decode())
+    return '<data encoding="base64">{0}</data>'.format(base64.b64encode(data).decode())
+
+def make_map(size, unique, encoding, layers=1):
+    payload = make_layer_payload(size, unique, encoding)
+    layer = '<layer name="ground" width="{0}" height="{0}">{1}</layer>'.format(size, payload)
+    return ('<map version="1.2" orientation="orthogonal" renderorder="right-down" '
+            'width="{0}" height="{0}" tilewidth="16" tileheight="16">'
+            '<tileset firstgid="1" name="bench" tilewidth="16" tileheight="16" tilecount="{1}" columns="8"/>'
+            '{2}'
+            '<objectgroup name="objects"><object id="1" name="spawn" x="16" y="16" width="16" height="16"/></objectgroup>'
+            '</map>').format(size, unique, layer*layers)
+
+# -- Reference decoder, the per cell loop TiledTileLayer.parse_xml used before bulk decoding
+def per_cell_decode(tiled_map, node):
+    width, height = int(node.get('width')), int(node.get('height'))
+    data_node = node.find('data')
+    data = None
+    next_gid = None
+    if data_node.get('encoding') == 'base64':
+        data = base64.b64decode(data_node.text.strip())
+    elif data_node.get('encoding') == 'csv':
+        next_gid = map(int, "".join(
+            line.strip() for line in data_node.text.strip()).split(","))
+    if data_node.get('compression') == 'zlib':
+        data = zlib.decompress(data)
+    if data:
+        fmt = struct.Struct('<L')
+        iterator = (data[i:i + 4] for i in range(0, len(data), 4))
+        next_gid = (fmt.unpack(i)[0] for i in iterator)
+
+    reg = tiled_map.register_gid
+    rows = tuple(array.array('H', [0] * width) for i in range(height))
+    for (y, x) in product(range(height), range(width)):
+        rows[y][x] = reg(*pytmx.pytmx.decode_gid(next(next_gid)))
+    return rows
+
+def best_time(func):
+    times = []
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+def bench_layer_decode(size=MAP_SIZE):
+    print('layer decode, {0}x{0} tiles, {1} unique gids'.format(size, UNIQUE_TILES))
+    for encoding in ['csv', 'base64', 'zlib']:
+        root = ElementTree.fromstring(make_map(size, UNIQUE_TILES, encoding))
+        node = root.find('layer')
+
+        def bulk():
+            tiled_map = pytmx.TiledMap()
+            pytmx.TiledTileLayer(tiled_map, node)
+
+        def per_cell():
+            tiled_map = pytmx.TiledMap()
+            per_cell_decode(tiled_map, node)
+
+        bulk_time = best_time(bulk)
+        cell_time = best_time(per_cell)
+        print('  {0:<7} bulk {1:7.1f} ms, per cell {2:7.1f} ms ({3:.1f}x)'.format(
+            encoding, bulk_time*1000, cell_time*1000, cell_time/bulk_time))
+
+def bench_layer_storage(size=MAP_SIZE):
+    print('layer storage, {0}x{0} tiles'.format(size))
+    root = ElementTree.fromstring(make_map(size, UNIQUE_TILES, 'base64'))
+    tiled_map = pytmx.TiledMap()
+    layer = pytmx.TiledTileLayer(tiled_map, root.find('layer'))
+    tiled_map.layers.append(layer)
+    rows = per_cell_decode(pytmx.TiledMap(), root.find('layer'))
+
+    row_bytes = sys.getsizeof(rows) + sum(sys.getsizeof(row) for row in rows)
+    print('  tuple of rows {0:7.1f} KB, contiguous {1:7.1f} KB'.format(
+        row_bytes/1024, sys.getsizeof(layer.data.gids)/1024))
+
+    def rows_scan():
+        for y, row in enumerate(rows):
+            for x, gid in enumerate(row):
+                pass
+
+    def contiguous_scan():
+        for y, row in enumerate(layer.data):
+            for x, gid in enumerate(row):
+                pass
+
+    print('  full scan: tuple of rows {0:7.1f} ms, contiguous {1:7.1f} ms'.format(
+        best_time(rows_scan)*1000, best_time(contiguous_scan)*1000))
+    print('  gid set: tuple of rows {0:7.1f} ms, contiguous {1:7.1f} ms'.format(
+        best_time(lambda: set(gid for row in rows for gid in row))*1000,
+        best_time(lambda: set(layer.data.gids))*1000))
+
+def peak_memory(func):
+    #tracing every allocation is slow, so timings are taken separately
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def bench_streaming(size=MAP_SIZE, megabytes=STREAM_MAP_MB):
+    layer_bytes = len(make_layer_payload(size, UNIQUE_TILES, 'csv'))
+    layers = max(1, megabytes*1024*1024//layer_bytes)
+    fd, path = tempfile.mkstemp(suffix='.tmx')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(make_map(size, UNIQUE_TILES, 'csv', layers))
+    print('streaming, {0} csv layers of {1}x{1} tiles, {2:.1f} MB file'.format(
+        layers, size, os.path.getsize(path)/1024/1024))
+    try:
+        for streaming in [False, True]:
+            load = lambda: pytmx.TiledMap(path, streaming=streaming)
+            duration = best_time(load)
+            peak = peak_memory(load)
+            print('  {0:<9} peak {1:7.1f} MB, {2:7.1f} ms'.format(
+                'iterparse' if streaming else 'parse', peak/1024/1024, duration*1000))
+    finally:
+        os.remove(path)
+
+def bench_gid_index(path=INDEX_MAP):
+    print('gid searches, {0}'.format(os.path.basename(path)))
+    for index_gids in [False, True]:
+        tiled_map = pytmx.TiledMap(path, index_gids=index_gids)
+        layers = list(tiled_map.visible_tile_layers)
+        gids = sorted(set(gid for l in layers for gid in tiled_map.layers[l].data.gids))
+
+        def locations():
+            for gid in gids:
+                list(tiled_map.get_tile_locations_by_gid(gid))
+
+        def properties():
+            for l in layers:
+                list(tiled_map.get_tile_properties_by_layer(l))
+
+        print('  {0:<8} {1} gids: locations {2:7.2f} ms, layer properties {3:7.2f} ms'.format(
+            'index' if index_gids else 'scan', len(gids),
+            best_time(locations)*1000, best_time(properties)*1000))
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else MAP_SIZE
+    bench_layer_decode(size)
+    bench_layer_storage(size)
+    bench_streaming(size)
+    bench_gid_index()
@@ -17,8 +17,16 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the GNU Lesser General Public
 License along with pytmx.  If not, see <http://www.gnu.org/licenses/>.
 """
+import array
+import hashlib
 import logging
+import mmap
 import os
+import pickle
+import struct
+import sys
+import time
+from bisect import bisect_right
 from collections import defaultdict, namedtuple
 from io import BytesIO
 from itertools import chain, product
@@ -31,6 +39,8 @@ __all__ = (
     'TiledMap',
     'TiledTileset',
     'TiledTileLayer',
+    'TileLayerData',
+    'ChunkedLayerData',
     'TiledObject',
     'TiledObjectGroup',
     'TiledImageLayer',
@@ -45,11 +55,22 @@ TRANS_FLIPX = 1
 TRANS_FLIPY = 2
 TRANS_ROT = 4
 
+# array typecode holding 32-bit Tiled gids
+gid_typecode = 'I' if array.array('I').itemsize == 4 else 'L'
+
 # Tiled gid flags
 GID_TRANS_FLIPX = 1 << 31
 GID_TRANS_FLIPY = 1 << 30
 GID_TRANS_ROT = 1 << 29
 
+# compiled map cache format
+compiled_magic = b'PYTMXC03'
+compiled_header = struct.Struct('<8sII')
+compiled_array = struct.Struct('<cI')
+# set by the caller or while loading images, so never taken from a compiled map
+compiled_exclude = ('filename', 'image_loader', 'cache_dir', 'streaming', 'index_gids',
+                    'image_workers', 'images', 'tileset_loaders', 'tileset_load_times')
+
 # error message format strings go here
 duplicate_name_fmt = 'Cannot set user {} property on {} "{}"; Tiled property already exists.'
 
@@ -90,6 +111,76 @@ def decode_gid(raw_gid):
     return gid, flags
 
 
+def decode_layer_data(data_node, encoding=None, compression=None):
+    """ Decode the payload of a TMX <data> node into an array of raw gids
+
+    csv text, base64 (optionally gzip or zlib compressed) and plain <tile>
+    elements are supported.  Raw gids still carry the Tiled flip flags.
+
+    :param data_node: ElementTree <data> or <chunk> element
+    :param encoding: encoding of a <chunk>, which is set on its <data>
+    :param compression: compression of a <chunk>, which is set on its <data>
+    :return: array.array of 32-bit unsigned ints
+    """
+    encoding = encoding or data_node.get('encoding', None)
+    compression = compression or data_node.get('compression', None)
+    if encoding:
+        return decode_gids(data_node.text, encoding, compression)
+
+    raw = array.array(gid_typecode)
+    raw.extend(int(child.get('gid', 0)) for child in data_node.findall('tile'))
+    return raw
+
+
+def decode_gids(text, encoding, compression=None):
+    """ Decode csv or base64 layer data text into an array of raw gids
+
+    :param text: text of a <data> or <chunk> element
+    :param encoding: 'csv' or 'base64'
+    :param compression: None, 'gzip' or 'zlib'
+    :return: array.array of 32-bit unsigned ints
+    """
+    raw = array.array(gid_typecode)
+
+    if encoding == 'base64':
+        from base64 import b64decode
+
+        data = b64decode(text.strip())
+
+        if compression == 'gzip':
+            import gzip
+
+            with gzip.GzipFile(fileobj=BytesIO(data)) as fh:
+                data = fh.read()
+
+        elif compression == 'zlib':
+            import zlib
+
+            data = zlib.decompress(data)
+
+        elif compression:
+            msg = 'TMX compression type: {0} is not supported.'
+            logger.error(msg.format(compression))
+            raise Exception(msg.format(compression))
+
+        raw.frombytes(data)
+        if sys.byteorder == 'big':
+            raw.byteswap()
+
+    elif encoding == 'csv':
+        # decode a row at a time; a list of every cell's text is far
+        # larger than the text or the decoded array
+        for line in text.split():
+            raw.extend(map(int, line.strip(',').split(',')))
+
+    else:
+        msg = 'TMX encoding type: {0} is not supported.'
+        logger.error(msg.format(encoding))
+        raise Exception(msg.format(encoding))
+
+    return raw
+
+
 def convert_to_bool(value):
     """ Convert a few common variations of "true" and "false" to boolean
 
@@ -158,6 +249,7 @@ types.update({
     "id": int,
     "opacity": float,
     "visible": convert_to_bool,
+    "infinite": convert_to_bool,
     "offsetx": int,
     "offsety": int,
     "encoding": str,
@@ -281,6 +373,9 @@ class TiledElement(object):
         self.properties = properties
 
     def __getattr__(self, item):
+        # properties may not exist yet, ie. while unpickling
+        if item == 'properties' or item.startswith('__'):
+            raise AttributeError(item)
         try:
             return self.properties[item]
         except KeyError:
@@ -311,6 +406,11 @@ class TiledMap(TiledElement):
         :param invert_y: invert the y axis
         :param load_all_tiles: load all tile images, even if never used
         :param allow_duplicate_names: allow duplicates in objects' metatdata
+        :param cache_dir: directory to keep compiled maps in, also passed to the image loader
+        :param streaming: parse the file incrementally to lower peak memory
+        :param index_gids: keep an index of where each gid is in each tile layer
+        :param image_workers: threads used to open tileset images; only use more
+            than 1 with a loader that is safe to call from other threads
 
         image_loader:
           this must be a reference to a function that will accept a tuple:
@@ -325,6 +425,10 @@ class TiledMap(TiledElement):
         self.optional_gids = kwargs.get('optional_gids', set())
         self.load_all_tiles = kwargs.get('load_all', True)
         self.invert_y = kwargs.get('invert_y', True)
+        self.cache_dir = kwargs.get('cache_dir', None)
+        self.streaming = kwargs.get('streaming', False)
+        self.index_gids = kwargs.get('index_gids', False)
+        self.image_workers = kwargs.get('image_workers', 1)
 
         # allow duplicate names to be parsed and loaded
         TiledElement.allow_duplicate_names = \
@@ -332,6 +436,8 @@ class TiledMap(TiledElement):
 
         self.layers = list()  # all layers in proper order
         self.tilesets = list()  # TiledTileset objects
+        self.tileset_firstgids = list()  # sorted, for get_tileset_from_gid
+        self.tilesets_by_firstgid = list()  # tilesets in the same order
         self.tile_properties = dict()  # tiles that have properties
         self.layernames = dict()
         self.objects_by_id = dict()
@@ -362,12 +468,17 @@ class TiledMap(TiledElement):
         self.staggerindex = None
         self.background_color = None
         self.nextobjectid = 0
+        self.infinite = False
 
         # initialize the gid mapping
         self.imagemap[(0, 0)] = 0
 
         if filename:
-            self.parse_xml(ElementTree.parse(self.filename).getroot())
+            if not (self.cache_dir and self.load_compiled()):
+                if self.streaming:
+                    self.parse_xml_stream(self.filename)
+                else:
+                    self.parse_xml(ElementTree.parse(self.filename).getroot())
 
     def __repr__(self):
         return '<{0}: "{1}">'.format(self.__class__.__name__, self.filename)
@@ -435,9 +546,168 @@ class TiledMap(TiledElement):
             if self.invert_y:
                 o.y -= o.height
 
+        if self.cache_dir and self.filename:
+            self.save_compiled()
+
+        self.build_gid_indexes()
         self.reload_images()
         return self
 
+    def parse_xml_stream(self, source):
+        """ Parse a map from a file without building the whole tree first
+
+        Tile layers are parsed as soon as their element is complete and then
+        dropped, so only one layer's xml is held at a time.  Everything else
+        (tilesets, object groups, image layers) is small; those elements are
+        kept and parsed at the end by parse_xml, in the usual load order so
+        gids come out the same as a normal load.
+
+        :param source: filename or file object
+        :return: self
+        """
+        root = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1 and elem.tag == 'layer':
+                self.add_layer(TiledTileLayer(self, elem))
+                root.remove(elem)
+                elem.clear()
+
+        return self.parse_xml(root)
+
+    @property
+    def compiled_filename(self):
+        """ Path of the compiled form of this map in the cache directory
+
+        The name depends on the path of the map and the options that change
+        how it is parsed; the contents are checked against file hashes.
+
+        :rtype: str
+        """
+        key = '{0}|{1}|{2}|{3}|{4}'.format(
+            os.path.abspath(self.filename), self.invert_y, self.load_all_tiles,
+            sorted(self.optional_gids), TiledElement.allow_duplicate_names)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.tmxc'
+        return os.path.join(self.cache_dir, 'maps', name)
+
+    def dependencies(self):
+        """ Return the files this map was parsed from
+
+        :rtype: list of paths: the tmx file and any external tsx files
+        """
+        return [self.filename] + [ts.filename for ts in self.tilesets if ts.filename]
+
+    @staticmethod
+    def _hash_file(path):
+        with open(path, 'rb') as fh:
+            return hashlib.sha1(fh.read()).hexdigest()
+
+    def save_compiled(self):
+        """ Write the parsed map to the cache directory in a binary form
+
+        Layer gid arrays are stored raw, after a pickle of everything else
+        (gid maps, tilesets, objects and properties).  Images and the options
+        given by the caller are not stored.  Must be called before images are
+        loaded.
+
+        :return: None
+        """
+        # chunked layers are small until decoded, so they are just pickled
+        layers = [l for l in self.layers
+                  if isinstance(l, TiledTileLayer) and isinstance(l.data, TileLayerData)]
+        data = [l.data for l in layers]
+        state = {k: v for k, v in self.__dict__.items() if k not in compiled_exclude}
+        try:
+            for layer in layers:
+                layer.data = None
+
+            buf = BytesIO()
+            pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = lambda obj: 'map' if obj is self else None
+            pickler.dump({
+                'dependencies': [(path, self._hash_file(path)) for path in self.dependencies()],
+                'state': state})
+        finally:
+            for layer, rows in zip(layers, data):
+                layer.data = rows
+
+        path = self.compiled_filename
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.' + str(os.getpid())
+        with open(temp_path, 'wb') as fh:
+            meta = buf.getvalue()
+            fh.write(compiled_header.pack(compiled_magic, len(meta), len(data)))
+            fh.write(meta)
+            for layer_data in data:
+                fh.write(compiled_array.pack(layer_data.gids.typecode.encode(), layer_data.view.nbytes))
+                fh.write(layer_data.view)
+        os.replace(temp_path, path)
+
+    def load_compiled(self):
+        """ Load the map from the cache directory, if it is up to date
+
+        The file is memory mapped and layer data is copied straight out of
+        it with array.frombytes.  If the tmx file or any tsx file it uses
+        changed since it was compiled, nothing is loaded.
+
+        :return: True if the map was loaded, otherwise False
+        """
+        try:
+            with open(self.compiled_filename, 'rb') as fh:
+                buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        with buf, memoryview(buf) as view:
+            try:
+                magic, meta_size, count = compiled_header.unpack_from(buf)
+                if magic != compiled_magic:
+                    return False
+                offset = compiled_header.size
+                unpickler = pickle.Unpickler(BytesIO(view[offset:offset + meta_size]))
+                unpickler.persistent_load = lambda pid: self
+                meta = unpickler.load()
+                for path, digest in meta['dependencies']:
+                    if not os.path.exists(path) or self._hash_file(path) != digest:
+                        return False
+
+                state = meta['state']
+                layers = [l for l in state['layers']
+                          if isinstance(l, TiledTileLayer) and l.data is None]
+                offset += meta_size
+                for layer in layers[:count]:
+                    typecode, size = compiled_array.unpack_from(buf, offset)
+                    offset += compiled_array.size
+                    gids = array.array(typecode.decode())
+                    gids.frombytes(view[offset:offset + size])
+                    layer.data = TileLayerData(layer.width, layer.height, gids)
+                    offset += size
+            except Exception:
+                logger.debug('Ignoring unreadable compiled map for {0}'.format(self.filename))
+                return False
+
+        self.__dict__.update(state)
+        self.build_gid_indexes()
+        self.reload_images()
+        return True
+
+    def build_gid_indexes(self):
+        """ Index gid locations of every tile layer, if index_gids is set
+
+        :return: None
+        """
+        if self.index_gids:
+            for layer in self.layers:
+                if isinstance(layer, TiledTileLayer) and isinstance(layer.data, TileLayerData):
+                    layer.data.build_index()
+
     def reload_images(self):
         """ Load the map images from disk
 
@@ -448,28 +718,29 @@ class TiledMap(TiledElement):
         :return: None
         """
         self.images = [None] * self.maxgid
+        self.tileset_loaders = dict()
+        self.tileset_load_times = dict()
 
-        # iterate through tilesets to get source images
-        for ts in self.tilesets:
+        # skip tilesets without a source
+        tilesets = [ts for ts in self.tilesets if ts.source is not None]
 
-            # skip tilesets without a source
-            if ts.source is None:
-                continue
+        # the loaders read and decode the tileset images, which can overlap;
+        # tiles are still cut out (and converted) on this thread
+        if self.image_workers > 1 and len(tilesets) > 1:
+            from concurrent.futures import ThreadPoolExecutor
 
-            path = os.path.join(os.path.dirname(self.filename), ts.source)
-            colorkey = getattr(ts, 'trans', None)
-            loader = self.image_loader(path, colorkey, tileset=ts)
+            with ThreadPoolExecutor(min(self.image_workers, len(tilesets))) as pool:
+                opened = list(pool.map(self.open_tileset_image, tilesets))
+        else:
+            opened = [self.open_tileset_image(ts) for ts in tilesets]
 
-            p = product(range(ts.margin,
-                              ts.height + ts.margin - ts.tileheight + 1,
-                              ts.tileheight + ts.spacing),
-                        range(ts.margin,
-                              ts.width + ts.margin - ts.tilewidth + 1,
-                              ts.tilewidth + ts.spacing))
+        # iterate through tilesets to get source images
+        for ts, (loader, open_time) in zip(tilesets, opened):
+            start = time.perf_counter()
+            self.tileset_loaders[ts.firstgid] = loader
 
             # iterate through the tiles
-            for real_gid, (y, x) in enumerate(p, ts.firstgid):
-                rect = (x, y, ts.tilewidth, ts.tileheight)
+            for real_gid, rect in enumerate(ts.tile_rects(), ts.firstgid):
                 gids = self.map_gid(real_gid)
 
                 # gids is None if the tile is never used
@@ -485,6 +756,11 @@ class TiledMap(TiledElement):
                     for gid, flags in gids:
                         self.images[gid] = loader(rect, flags)
 
+            tiles_time = time.perf_counter() - start
+            self.tileset_load_times[ts.name] = (open_time, tiles_time)
+            logger.debug('Tileset {0}: image {1:.1f} ms, tiles {2:.1f} ms'.format(
+                ts.name, open_time * 1000, tiles_time * 1000))
+
         # load image layer images
         for layer in (i for i in self.layers if isinstance(i, TiledImageLayer)):
             source = getattr(layer, 'source', None)
@@ -494,7 +770,7 @@ class TiledMap(TiledElement):
                 gid = self.register_gid(real_gid)
                 layer.gid = gid
                 path = os.path.join(os.path.dirname(self.filename), source)
-                loader = self.image_loader(path, colorkey)
+                loader = self.image_loader(path, colorkey, cache_dir=self.cache_dir)
                 image = loader()
                 self.images.append(image)
 
@@ -506,10 +782,55 @@ class TiledMap(TiledElement):
             if source:
                 colorkey = props.get('trans', None)
                 path = os.path.join(os.path.dirname(self.filename), source)
-                loader = self.image_loader(path, colorkey)
+                loader = self.image_loader(path, colorkey, cache_dir=self.cache_dir)
                 image = loader()
                 self.images[real_gid] = image
 
+    def open_tileset_image(self, ts):
+        """ Create the image loader for a tileset, timing it
+
+        Runs on worker threads when image_workers is more than 1.
+
+        :param ts: TiledTileset with a source image
+        :rtype: (loader, seconds) tuple
+        """
+        start = time.perf_counter()
+        path = os.path.join(os.path.dirname(self.filename), ts.source)
+        colorkey = getattr(ts, 'trans', None)
+        loader = self.image_loader(path, colorkey, tileset=ts, cache_dir=self.cache_dir)
+        return loader, time.perf_counter() - start
+
+    def load_new_tile_images(self):
+        """ Load images for gids registered after reload_images
+
+        Chunks of infinite maps are decoded when first read, and may use
+        tiles, or flipped tiles, that were not registered when the images
+        were loaded.
+
+        :return: None
+        """
+        start = len(self.images)
+        self.images.extend([None] * (self.maxgid - start))
+        rects = dict()
+        for gid in range(start, self.maxgid):
+            tiled_gid = self.tiledgidmap[gid]
+            flags = [f for g, f in self.gidmap[tiled_gid] if g == gid][0]
+            try:
+                ts = self.get_tileset_from_gid(gid)
+            except ValueError:
+                continue
+            loader = self.tileset_loaders.get(ts.firstgid)
+            if loader is None:
+                continue
+
+            if ts.firstgid not in rects:
+                rects[ts.firstgid] = ts.tile_rects()
+            try:
+                rect = rects[ts.firstgid][tiled_gid - ts.firstgid]
+            except IndexError:
+                continue
+            self.images[gid] = loader(rect, flags)
+
     def get_tile_image(self, x, y, layer):
         """ Return the tile image for this location
 
@@ -518,7 +839,7 @@ class TiledMap(TiledElement):
         :param layer: layer number
         :rtype: surface if found, otherwise 0
         """
-        if not (x >= 0 and y >= 0):
+        if not (x >= 0 and y >= 0 or self.infinite):
             raise ValueError("Tile coordinates must be non-negative, were ({0}, {1})".format(x,y))
 
         try:
@@ -529,7 +850,7 @@ class TiledMap(TiledElement):
         assert (isinstance(layer, TiledTileLayer))
 
         try:
-            gid = layer.data[y][x]
+            gid = layer.data.get(x, y)
         except (IndexError, ValueError):
             raise ValueError("GID not found")
         except TypeError:
@@ -566,16 +887,96 @@ class TiledMap(TiledElement):
         :param layer: layer number
         :rtype: surface if found, otherwise ValueError
         """
-        if not (x >= 0 and y >= 0 and layer >= 0):
+        if not ((x >= 0 and y >= 0 or self.infinite) and layer >= 0):
+            raise ValueError("Tile coordinates and layers must be non-negative, were ({0}, {1}), layer={2}".format(x,y, layer))
+
+        try:
+            return self.layers[int(layer)].data.get(int(x), int(y))
+        except (IndexError, ValueError):
+            msg = "Coords: ({0},{1}) in layer {2} is invalid"
+            logger.debug(msg.format(x, y, layer))
+            raise ValueError(msg.format(x, y, layer))
+
+    def set_tile_gid(self, x, y, layer, gid):
+        """ Change the tile at this location
+
+        Keeps the gid index of the layer up to date, if there is one.
+
+        :param x: x coordinate
+        :param y: y coordinate
+        :param layer: layer number
+        :param gid: pytmx gid of the new tile, 0 to clear it
+        """
+        if not ((x >= 0 and y >= 0 or self.infinite) and layer >= 0):
             raise ValueError("Tile coordinates and layers must be non-negative, were ({0}, {1}), layer={2}".format(x,y, layer))
+        if not 0 <= gid < self.maxgid:
+            raise ValueError("GID not found: {0}".format(gid))
 
         try:
-            return self.layers[int(layer)].data[int(y)][int(x)]
+            self.layers[int(layer)].data.set(int(x), int(y), gid)
         except (IndexError, ValueError):
             msg = "Coords: ({0},{1}) in layer {2} is invalid"
             logger.debug(msg.format(x, y, layer))
             raise ValueError(msg.format(x, y, layer))
 
+    def get_tile_gids_in_rect(self, layer, rect):
+        """ Return the tiles of a layer inside an area, as gids
+
+        Only the rows (or chunks) under the area are read.
+
+        :param layer: layer number
+        :param rect: (x, y, width, height) in tiles, or a pygame Rect
+        :rtype: list of (x, y, gid) tuples, without empty tiles
+        """
+        try:
+            data = self.layers[int(layer)].data
+        except (IndexError, ValueError, AttributeError):
+            raise ValueError("Tile layer not found: {0}".format(layer))
+
+        x, y, width, height = rect
+        return data.tiles_in_rect(x, y, width, height)
+
+    def evict_chunks(self, rect):
+        """ Drop the decoded chunks of infinite map layers outside an area
+
+        Memory then follows the area in use instead of the whole map.  See
+        ChunkedLayerData.evict.
+
+        :param rect: (x, y, width, height) in tiles, or a pygame Rect
+        :rtype: int, number of chunks evicted
+        """
+        x, y, width, height = rect
+        return sum(layer.data.evict(x, y, width, height) for layer in self.layers
+                   if isinstance(getattr(layer, 'data', None), ChunkedLayerData))
+
+    def get_tiles_in_rect(self, layer, rect):
+        """ Return the tiles of a layer inside an area, as images
+
+        :param layer: layer number
+        :param rect: (x, y, width, height) in tiles, or a pygame Rect
+        :rtype: list of (x, y, image) tuples, without empty tiles
+        """
+        images = self.images
+        return [(x, y, images[gid]) for x, y, gid in self.get_tile_gids_in_rect(layer, rect)
+                if images[gid]]
+
+    def get_tile_blits_in_rect(self, layer, rect, offset=(0, 0)):
+        """ Return the tiles of a layer inside an area, ready for blitting
+
+        The result can be passed to pygame's Surface.blits.  Positions are
+        in pixels, from the origin of the map plus offset.
+
+        :param layer: layer number
+        :param rect: (x, y, width, height) in tiles, or a pygame Rect
+        :param offset: (x, y) added to every position, in pixels
+        :rtype: list of (image, (x, y)) tuples
+        """
+        images = self.images
+        tw, th = self.tilewidth, self.tileheight
+        ox, oy = offset
+        return [(images[gid], (x * tw + ox, y * th + oy))
+                for x, y, gid in self.get_tile_gids_in_rect(layer, rect) if images[gid]]
+
     def get_tile_properties(self, x, y, layer):
         """ Return the tile image GID for this location
 
@@ -584,11 +985,11 @@ class TiledMap(TiledElement):
         :param layer: layer number
         :rtype: python dict if found, otherwise None
         """
-        if not (x >= 0 and y >= 0 and layer >= 0):
+        if not ((x >= 0 and y >= 0 or self.infinite) and layer >= 0):
             raise ValueError("Tile coordinates and layers must be non-negative, were ({0}, {1}), layer={2}".format(x,y, layer))
 
         try:
-            gid = self.layers[int(layer)].data[int(y)][int(x)]
+            gid = self.layers[int(layer)].data.get(int(x), int(y))
         except (IndexError, ValueError):
             msg = "Coords: ({0},{1}) in layer {2} is invalid."
             logger.debug(msg.format(x, y, layer))
@@ -610,13 +1011,13 @@ class TiledMap(TiledElement):
         Return (int, int, int) tuples, where the layer is index of
         the visible tile layers.
 
-        Note: Not a fast operation.  Cache results if used often.
+        Note: Scans every tile unless the map was loaded with index_gids.
 
         :param gid: GID to be searched for
         :rtype: generator of tile locations
         """
         for l in self.visible_tile_layers:
-            for x, y, _gid in [i for i in self.layers[l].iter_data() if i[2] == gid]:
+            for x, y in self.layers[l].data.locations(gid):
                 yield x, y, l
 
     def get_tile_properties_by_gid(self, gid):
@@ -652,8 +1053,7 @@ class TiledMap(TiledElement):
             logger.debug(msg.format(type(layer)))
             raise ValueError
 
-        p = product(range(self.width), range(self.height))
-        layergids = set(self.layers[layer].data[y][x] for x, y in p)
+        layergids = self.layers[layer].data.unique_gids()
 
         for gid in layergids:
             try:
@@ -680,6 +1080,18 @@ class TiledMap(TiledElement):
         """
         assert (isinstance(tileset, TiledTileset))
         self.tilesets.append(tileset)
+        self.index_tilesets()
+
+    def index_tilesets(self):
+        """ Sort the tileset boundaries used to find the tileset of a gid
+
+        Called by add_tileset; call it if self.tilesets is changed directly.
+
+        :return: None
+        """
+        ordered = sorted(self.tilesets, key=attrgetter('firstgid'))
+        self.tileset_firstgids = [ts.firstgid for ts in ordered]
+        self.tilesets_by_firstgid = ordered
 
     def get_layer_by_name(self, name):
         """Return a layer by name
@@ -713,9 +1125,6 @@ class TiledMap(TiledElement):
     def get_tileset_from_gid(self, gid):
         """ Return tileset that owns the gid
 
-        Note: this is a slow operation, so if you are expecting to do this
-              often, it would be worthwhile to cache the results of this.
-
         :param gid: gid of tile image
         :rtype: TiledTileset if found, otherwise ValueError
         """
@@ -724,12 +1133,30 @@ class TiledMap(TiledElement):
         except KeyError:
             raise ValueError("Tile GID not found")
 
-        for tileset in sorted(self.tilesets, key=attrgetter('firstgid'),
-                              reverse=True):
-            if tiled_gid >= tileset.firstgid:
-                return tileset
+        if len(self.tileset_firstgids) != len(self.tilesets):
+            self.index_tilesets()
+
+        i = bisect_right(self.tileset_firstgids, tiled_gid) - 1
+        if i < 0:
+            raise ValueError("Tileset not found")
+        return self.tilesets_by_firstgid[i]
 
-        raise ValueError("Tileset not found")
+    def get_tilesets_from_gids(self, gids):
+        """ Return the tilesets that own many gids
+
+        Each distinct gid is looked up once, so this suits whole layers,
+        e.g. grouping tiles by tileset image to draw them in batches.
+
+        :param gids: iterable of gids
+        :rtype: dict of gid: TiledTileset, without gids that have no tileset
+        """
+        found = dict()
+        for gid in set(gids):
+            try:
+                found[gid] = self.get_tileset_from_gid(gid)
+            except ValueError:
+                continue
+        return found
 
     def get_tile_colliders(self):
         """Return iterator of (gid, dict) pairs of tiles with colliders"""
@@ -781,6 +1208,26 @@ class TiledMap(TiledElement):
         return (i for (i, l) in enumerate(self.layers)
                 if l.visible and isinstance(l, TiledObjectGroup))
 
+    def translate_gids(self, raw):
+        """ Translate raw gids from layer data into pytmx gids
+
+        Flags are decoded and gids registered once per unique raw gid, in
+        order of first appearance, so the gids are the same as when
+        registering cell by cell.
+
+        :param raw: array of raw gids, flip flags included
+        :rtype: array.array of pytmx gids
+        """
+        reg = self.register_gid
+        lut = {raw_gid: reg(*decode_gid(raw_gid))
+               for raw_gid in dict.fromkeys(raw)}
+
+        # only chunks decoded after loading can add gids once images exist
+        if self.images and self.maxgid > len(self.images):
+            self.load_new_tile_images()
+
+        return array.array(gid_typecode, map(lut.__getitem__, raw))
+
     def register_gid(self, tiled_gid, flags=None):
         """ Used to manage the mapping of GIDs between the tmx and pytmx
 
@@ -848,6 +1295,7 @@ class TiledTileset(TiledElement):
         self.offset = (0, 0)
 
         # defaults from the specification
+        self.filename = None  # path of an external tsx file
         self.firstgid = 0
         self.source = None
         self.name = None
@@ -865,6 +1313,19 @@ class TiledTileset(TiledElement):
 
         self.parse_xml(node)
 
+    def tile_rects(self):
+        """ Return the area of every tile in the tileset image, by tile id
+
+        :rtype: list of (x, y, width, height) tuples
+        """
+        p = product(range(self.margin,
+                          self.height + self.margin - self.tileheight + 1,
+                          self.tileheight + self.spacing),
+                    range(self.margin,
+                          self.width + self.margin - self.tilewidth + 1,
+                          self.tilewidth + self.spacing))
+        return [(x, y, self.tilewidth, self.tileheight) for y, x in p]
+
     def parse_xml(self, node):
         """ Parse a Tileset from ElementTree xml element
 
@@ -887,6 +1348,7 @@ class TiledTileset(TiledElement):
                 # we need to mangle the path - tiled stores relative paths
                 dirname = os.path.dirname(self.parent.filename)
                 path = os.path.abspath(os.path.join(dirname, source))
+                self.filename = path
                 if not os.path.exists(path):
                     #raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
                     raise Exception("Cannot find tileset file {0} from {1}, should be at {2}".format(source, self.parent.filename, path))
@@ -971,6 +1433,357 @@ class TiledTileset(TiledElement):
         return self
 
 
+class TileLayerData(object):
+    """ Tile gids of a layer, stored row by row in one 32-bit array
+
+    Indexing by row returns a memoryview of that row, so data[y][x] works
+    as it did when layers were a tuple of arrays, without copying.  Use get()
+    for single tiles, view for the whole buffer, and as_numpy() for a 2-D
+    NumPy array sharing the same memory.
+    """
+
+    def __init__(self, width, height, gids=None):
+        self.width = width
+        self.height = height
+        if gids is None:
+            gids = array.array(gid_typecode, bytes(width * height * 4))
+        self.gids = gids
+        self.view = memoryview(gids)
+        self.index = None  # gid: set of positions in gids, see build_index
+
+    def __reduce__(self):
+        return self.__class__, (self.width, self.height, self.gids)
+
+    def __len__(self):
+        return self.height
+
+    def __iter__(self):
+        width = self.width
+        for start in range(0, width * self.height, width):
+            yield self.view[start:start + width]
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return [self[i] for i in range(*y.indices(self.height))]
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError('row {0} out of range'.format(y))
+        start = y * self.width
+        return self.view[start:start + self.width]
+
+    def get(self, x, y):
+        """ Return the gid at x, y
+
+        :param x: x coordinate
+        :param y: y coordinate
+        :rtype: int, otherwise IndexError
+        """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError('tile ({0}, {1}) out of range'.format(x, y))
+        return self.gids[y * self.width + x]
+
+    def set(self, x, y, gid):
+        """ Set the gid at x, y
+
+        :param x: x coordinate
+        :param y: y coordinate
+        :param gid: pytmx gid
+        """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError('tile ({0}, {1}) out of range'.format(x, y))
+        i = y * self.width + x
+        if self.index is not None:
+            self.index[self.gids[i]].discard(i)
+            self.index[gid].add(i)
+        self.gids[i] = gid
+
+    def build_index(self):
+        """ Index the positions of each gid, for locations() and unique_gids()
+
+        The index is kept up to date by set().
+
+        :return: None
+        """
+        index = defaultdict(set)
+        for i, gid in enumerate(self.gids):
+            index[gid].add(i)
+        self.index = index
+
+    def locations(self, gid):
+        """ Return the positions of a gid, in row order
+
+        Uses the index if there is one, otherwise scans the layer.
+
+        :param gid: pytmx gid
+        :rtype: list of (x, y) tuples
+        """
+        width = self.width
+        if self.index is not None:
+            found = sorted(self.index.get(gid, ()))
+        else:
+            found = [i for i, g in enumerate(self.gids) if g == gid]
+        return [(i % width, i // width) for i in found]
+
+    def region(self, x, y, width, height):
+        """ Return rows of a rectangular area, clipped to the layer
+
+        :param x: left tile
+        :param y: top tile
+        :param width: width in tiles
+        :param height: height in tiles
+        :rtype: list of (y, memoryview) tuples; each view starts at column x
+        """
+        left, right = max(x, 0), min(x + width, self.width)
+        top, bottom = max(y, 0), min(y + height, self.height)
+        if left >= right:
+            return list()
+        stride = self.width
+        return [(row, self.view[row * stride + left:row * stride + right])
+                for row in range(top, bottom)]
+
+    def tiles_in_rect(self, x, y, width, height):
+        """ Return the tiles inside an area, clipped to the layer
+
+        :param x: left tile
+        :param y: top tile
+        :param width: width in tiles
+        :param height: height in tiles
+        :rtype: list of (x, y, gid) tuples, without empty tiles
+        """
+        left = max(x, 0)
+        tiles = list()
+        for row, gids in self.region(x, y, width, height):
+            tiles += [(left + i, row, gid) for i, gid in enumerate(gids) if gid]
+        return tiles
+
+    def iter_data(self):
+        """ Yield x, y, gid for every tile
+
+        :rtype: Generator
+        """
+        for y, row in enumerate(self):
+            for x, gid in enumerate(row):
+                yield x, y, gid
+
+    def unique_gids(self):
+        """ Return the set of gids used
+
+        :rtype: set
+        """
+        if self.index is not None:
+            return {gid for gid, found in self.index.items() if found}
+        return set(self.gids)
+
+    def as_numpy(self):
+        """ Return the gids as a (height, width) NumPy array
+
+        The array shares memory with this layer.  NumPy is only imported
+        when this is called.
+
+        :rtype: numpy.ndarray, otherwise ImportError
+        """
+        import numpy
+
+        return numpy.frombuffer(self.gids, dtype=numpy.uint32).reshape(self.height, self.width)
+
+
+class ChunkedLayerData(object):
+    """ Tile gids of an infinite layer, stored as sparse chunks
+
+    Chunks are kept as they are in the file, encoded and usually compressed,
+    and decoded to a TileLayerData the first time one of their tiles is
+    read, so memory grows with the area actually visited rather than the
+    bounding box of the layer.  evict() drops decoded chunks away from an
+    area of interest.  Tiles outside of any chunk are empty (gid 0), and
+    coordinates may be negative.
+    """
+
+    def __init__(self, parent, encoding=None, compression=None):
+        self.parent = parent
+        self.encoding = encoding
+        self.compression = compression
+        self.chunk_width = 0
+        self.chunk_height = 0
+        self.encoded = dict()  # (chunk x, chunk y): text, or raw gids of unencoded chunks
+        self.chunks = dict()  # (chunk x, chunk y): decoded TileLayerData
+        self.modified = set()  # chunks changed by set(), never evicted
+
+    def add_chunk(self, node):
+        """ Store a <chunk> element without decoding it
+
+        :param node: ElementTree <chunk> element
+        """
+        width, height = int(node.get('width')), int(node.get('height'))
+        if not self.chunk_width:
+            self.chunk_width, self.chunk_height = width, height
+        elif (width, height) != (self.chunk_width, self.chunk_height):
+            msg = 'Chunks of different sizes in one layer are not supported.'
+            logger.error(msg)
+            raise Exception(msg)
+
+        key = int(node.get('x')) // width, int(node.get('y')) // height
+        if self.encoding:
+            self.encoded[key] = node.text.strip()
+        else:
+            self.encoded[key] = decode_layer_data(node)
+
+    def keys(self):
+        """ Return chunk coordinates of every chunk, decoded or not
+
+        :rtype: set of (chunk x, chunk y) tuples
+        """
+        return self.encoded.keys() | self.chunks.keys()
+
+    def chunk(self, cx, cy):
+        """ Return the chunk at chunk coordinates, decoding it if needed
+
+        :param cx: chunk column
+        :param cy: chunk row
+        :rtype: TileLayerData, or None if there is no chunk there
+        """
+        key = cx, cy
+        try:
+            return self.chunks[key]
+        except KeyError:
+            pass
+
+        raw = self.encoded.get(key)
+        if raw is None:
+            return None
+        if not isinstance(raw, array.array):
+            raw = decode_gids(raw, self.encoding, self.compression)
+
+        size = self.chunk_width * self.chunk_height
+        if len(raw) < size:
+            msg = 'chunk data not in expected format (expected {0} tiles, got {1})'
+            logger.error(msg.format(size, len(raw)))
+            raise Exception(msg.format(size, len(raw)))
+
+        data = TileLayerData(self.chunk_width, self.chunk_height,
+                             self.parent.translate_gids(raw[:size]))
+        self.chunks[key] = data
+        return data
+
+    def get(self, x, y):
+        """ Return the gid at x, y
+
+        :param x: x coordinate
+        :param y: y coordinate
+        :rtype: int
+        """
+        cx, x = divmod(x, self.chunk_width)
+        cy, y = divmod(y, self.chunk_height)
+        chunk = self.chunk(cx, cy)
+        if chunk is None:
+            return 0
+        return chunk.gids[y * self.chunk_width + x]
+
+    def set(self, x, y, gid):
+        """ Set the gid at x, y, adding a chunk if there is none
+
+        :param x: x coordinate
+        :param y: y coordinate
+        :param gid: pytmx gid
+        """
+        cx, x = divmod(x, self.chunk_width)
+        cy, y = divmod(y, self.chunk_height)
+        chunk = self.chunk(cx, cy)
+        if chunk is None:
+            chunk = self.chunks[(cx, cy)] = TileLayerData(self.chunk_width, self.chunk_height)
+        chunk.gids[y * self.chunk_width + x] = gid
+        self.modified.add((cx, cy))
+
+    def _chunk_range(self, x, y, width, height):
+        columns = range(x // self.chunk_width, (x + width - 1) // self.chunk_width + 1)
+        rows = range(y // self.chunk_height, (y + height - 1) // self.chunk_height + 1)
+        return columns, rows
+
+    def chunks_in_rect(self, x, y, width, height):
+        """ Yield the chunks overlapping an area, decoding them if needed
+
+        :param x: left tile
+        :param y: top tile
+        :param width: width in tiles
+        :param height: height in tiles
+        :rtype: Generator of (left tile, top tile, TileLayerData) tuples
+        """
+        columns, rows = self._chunk_range(x, y, width, height)
+        for cy in rows:
+            for cx in columns:
+                chunk = self.chunk(cx, cy)
+                if chunk is not None:
+                    yield cx * self.chunk_width, cy * self.chunk_height, chunk
+
+    def tiles_in_rect(self, x, y, width, height):
+        """ Return the tiles inside an area, decoding the chunks under it
+
+        :param x: left tile
+        :param y: top tile
+        :param width: width in tiles
+        :param height: height in tiles
+        :rtype: list of (x, y, gid) tuples, without empty tiles
+        """
+        tiles = list()
+        for left, top, chunk in self.chunks_in_rect(x, y, width, height):
+            for tx, ty, gid in chunk.tiles_in_rect(x - left, y - top, width, height):
+                tiles.append((left + tx, top + ty, gid))
+        return tiles
+
+    def evict(self, x, y, width, height):
+        """ Drop decoded chunks that do not overlap an area
+
+        Evicted chunks are decoded again from the file data when next read.
+        Chunks changed with set() are kept.
+
+        :param x: left tile
+        :param y: top tile
+        :param width: width in tiles
+        :param height: height in tiles
+        :rtype: int, number of chunks evicted
+        """
+        columns, rows = self._chunk_range(x, y, width, height)
+        evicted = [key for key in self.chunks
+                   if key not in self.modified and not (key[0] in columns and key[1] in rows)]
+        for key in evicted:
+            del self.chunks[key]
+        return len(evicted)
+
+    @property
+    def decoded_bytes(self):
+        return sum(chunk.view.nbytes for chunk in self.chunks.values())
+
+    def iter_data(self):
+        """ Yield x, y, gid for every tile in every chunk
+
+        This decodes the whole layer.
+
+        :rtype: Generator
+        """
+        for cx, cy in sorted(self.keys(), key=lambda key: (key[1], key[0])):
+            left, top = cx * self.chunk_width, cy * self.chunk_height
+            for x, y, gid in self.chunk(cx, cy).iter_data():
+                yield left + x, top + y, gid
+
+    def locations(self, gid):
+        """ Return the positions of a gid; this decodes the whole layer
+
+        :param gid: pytmx gid
+        :rtype: list of (x, y) tuples
+        """
+        return [(x, y) for x, y, g in self.iter_data() if g == gid]
+
+    def unique_gids(self):
+        """ Return the set of gids used; this decodes the whole layer
+
+        :rtype: set
+        """
+        gids = set()
+        for key in self.keys():
+            gids.update(self.chunk(*key).gids)
+        return gids
+
+
 class TiledTileLayer(TiledElement):
     """ Represents a TileLayer
 
@@ -1003,9 +1816,7 @@ class TiledTileLayer(TiledElement):
 
         :return: Generator
         """
-        for y, row in enumerate(self.data):
-            for x, gid in enumerate(row):
-                yield x, y, gid
+        return self.data.iter_data()
 
     def tiles(self):
         """ Iterate over tile images of this layer
@@ -1032,81 +1843,32 @@ class TiledTileLayer(TiledElement):
     def parse_xml(self, node):
         """ Parse a Tile Layer from ElementTree xml node
 
+        The layer payload is decoded in bulk into a 32-bit array; flip flags
+        are decoded and gids registered once per unique raw gid rather than
+        once per cell.
+
         :param node: ElementTree xml node
         :return: self
         """
-        import struct
-        import array
-
         self._set_properties(node)
-        data = None
-        next_gid = None
         data_node = node.find('data')
         chunk_nodes = data_node.findall('chunk')
         if chunk_nodes:
-            msg = 'TMX map size: infinite is not supported.'
-            logger.error(msg)
-            raise Exception
-
-        encoding = data_node.get('encoding', None)
-        if encoding == 'base64':
-            from base64 import b64decode
-
-            data = b64decode(data_node.text.strip())
-
-        elif encoding == 'csv':
-            next_gid = map(int, "".join(
-                line.strip() for line in data_node.text.strip()).split(","))
-
-        elif encoding:
-            msg = 'TMX encoding type: {0} is not supported.'
-            logger.error(msg.format(encoding))
-            raise Exception(msg.format(encoding))
-
-        compression = data_node.get('compression', None)
-        if compression == 'gzip':
-            import gzip
-
-            with gzip.GzipFile(fileobj=BytesIO(data)) as fh:
-                data = fh.read()
-
-        elif compression == 'zlib':
-            import zlib
-
-            data = zlib.decompress(data)
-
-        elif compression:
-            msg = 'TMX compression type: {0} is not supported.'
-            logger.error(msg.format(compression))
-            raise Exception(msg.format(compression))
-
-        # if data is None, then it was not decoded or decompressed, so
-        # we assume here that it is going to be a bunch of tile elements
-        # TODO: this will/should raise an exception if there are no tiles
-        if encoding == next_gid is None:
-            def get_children(parent):
-                for child in parent.findall('tile'):
-                    yield int(child.get('gid'))
-
-            next_gid = get_children(data_node)
-
-        elif data:
-            if type(data) == bytes:
-                fmt = struct.Struct('<L')
-                iterator = (data[i:i + 4] for i in range(0, len(data), 4))
-                next_gid = (fmt.unpack(i)[0] for i in iterator)
-            else:
-                msg = 'layer data not in expected format ({})'
-                logger.error(msg.format(type(data)))
-                raise Exception(msg.format(type(data)))
-
-        init = lambda: [0] * self.width
-        reg = self.parent.register_gid
-
-        # H (16-bit) may be a limitation for very detailed maps
-        self.data = tuple(array.array('H', init()) for i in range(self.height))
-        for (y, x) in product(range(self.height), range(self.width)):
-            self.data[y][x] = reg(*decode_gid(next(next_gid)))
+            self.data = ChunkedLayerData(self.parent, data_node.get('encoding', None),
+                                         data_node.get('compression', None))
+            for chunk_node in chunk_nodes:
+                self.data.add_chunk(chunk_node)
+            return self
+
+        raw = decode_layer_data(data_node)
+        size = self.width * self.height
+        if len(raw) < size:
+            msg = 'layer data not in expected format (expected {0} tiles, got {1})'
+            logger.error(msg.format(size, len(raw)))
+            raise Exception(msg.format(size, len(raw)))
+
+        gids = self.parent.translate_gids(raw[:size])
+        self.data = TileLayerData(self.width, self.height, gids)
 
         return self
 
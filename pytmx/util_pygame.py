@@ -17,8 +17,13 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the GNU Lesser General Public
 License along with pytmx.  If not, see <http://www.gnu.org/licenses/>.
 """
-import itertools
+import hashlib
+import json
 import logging
+import mmap
+import os
+import struct
+import threading
 
 import pytmx
 
@@ -31,7 +36,8 @@ except ImportError:
     logger.error('cannot import pygame (is it installed?)')
     raise
 
-__all__ = ['load_pygame', 'pygame_image_loader', 'simplify', 'build_rects']
+__all__ = ['load_pygame', 'pygame_image_loader', 'load_image_file', 'simplify', 'build_rects',
+           'greedy_rects']
 
 
 def handle_transformation(tile, flags):
@@ -42,13 +48,19 @@ def handle_transformation(tile, flags):
     return tile
 
 
-def smart_convert(original, colorkey, pixelalpha):
+alpha_threshold = 254  # the default of pygame.mask.from_surface
+
+
+def smart_convert(original, colorkey, pixelalpha, opaque=None):
     """
     this method does several interactive_tests on a surface to determine the optimal
     flags and pixel format for each tile surface.
 
     this is done for the best rendering speeds and removes the need to
     convert() the images on your own
+
+    opaque tells if the tile has no transparent pixels, if the caller
+    already knows (see classify_tiles)
     """
     # tiled set a colorkey
     if colorkey:
@@ -58,19 +70,19 @@ def smart_convert(original, colorkey, pixelalpha):
 
     # no colorkey, so use a mask to determine if there are transparent pixels
     else:
-        tile_size = original.get_size()
-        threshold = 254  # the default
-
-        try:
-            # count the number of pixels in the tile that are not transparent
-            px = pygame.mask.from_surface(original, threshold).count()
-        except:
-            # pygame_sdl2 will fail because the mask module is not included
-            # in this case, just convert_alpha and return it
-            return original.convert_alpha()
+        if opaque is None:
+            tile_size = original.get_size()
+            try:
+                # count the number of pixels in the tile that are not transparent
+                px = pygame.mask.from_surface(original, alpha_threshold).count()
+            except:
+                # pygame_sdl2 will fail because the mask module is not included
+                # in this case, just convert_alpha and return it
+                return original.convert_alpha()
+            opaque = px == tile_size[0] * tile_size[1]
 
         # there are no transparent pixels in the image
-        if px == tile_size[0] * tile_size[1]:
+        if opaque:
             tile = original.convert()
 
         # there are transparent pixels, and set for perpixel alpha
@@ -84,6 +96,125 @@ def smart_convert(original, colorkey, pixelalpha):
     return tile
 
 
+def to_rgba(surface):
+    """ Return a per-pixel alpha copy of a surface without needing a display
+
+    colorkeyed and opaque images are blitted onto a transparent surface, so
+    the result is always 32-bit RGBA.
+    """
+    if surface.get_flags() & pygame.SRCALPHA:
+        return surface
+    rgba = pygame.Surface(surface.get_size(), pygame.SRCALPHA)
+    rgba.blit(surface, (0, 0))
+    return rgba
+
+
+pixel_header = struct.Struct('<II')
+
+
+def load_image_file(filename, scale=None, cache_dir=None):
+    """ Load an image file, optionally through a cache of decoded pixels
+
+    Without a cache_dir this is pygame.image.load followed by an optional
+    scale.  With a cache_dir, the decoded and scaled RGBA pixels are kept on
+    disk, keyed by path, mtime, size and scale.  A warm load maps the file
+    copy-on-write and builds the surface with pygame.image.frombuffer, so no
+    PNG decompression happens at all and the surface can still be drawn on.  Changing the source file changes its key,
+    so stale entries are never used.
+
+    The surface returned is not converted to the display format, so this is
+    safe to call from worker threads.
+
+    :param filename: path of the image
+    :param scale: optional magnification factor
+    :param cache_dir: directory for the pixel cache, or None to disable it
+    :rtype: pygame Surface
+    """
+    cache_path = None
+    if cache_dir:
+        stat = os.stat(filename)
+        key = '{0}|{1}|{2}|{3}'.format(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, scale)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.rgba'
+        cache_path = os.path.join(cache_dir, 'pixels', name)
+        try:
+            with open(cache_path, 'rb') as fh:
+                buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+            size = pixel_header.unpack_from(buf)
+            return pygame.image.frombuffer(memoryview(buf)[pixel_header.size:], size, 'RGBA')
+        except (OSError, ValueError, struct.error):
+            pass
+
+    image = pygame.image.load(filename)
+    if scale is not None:
+        size = tuple(int(scale * i) for i in image.get_size())
+        image = pygame.transform.scale(to_rgba(image), size)
+
+    if cache_path:
+        image = to_rgba(image)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = '{0}.{1}.{2}'.format(cache_path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as fh:
+            fh.write(pixel_header.pack(*image.get_size()))
+            fh.write(pygame.image.tobytes(image, 'RGBA'))
+        os.replace(temp_path, cache_path)
+
+    return image
+
+
+def classify_tiles(filename, image, rects, cache_dir=None):
+    """ Find which tiles of an image have no transparent pixels
+
+    One mask is made for the whole image, and each tile counts its opaque
+    pixels in it.  With a cache_dir, the answers are kept in a sidecar file
+    named by the hash of the image file, so later loads of an unchanged
+    image make no mask at all.  Flipping or rotating a tile does not change
+    its answer, so one entry covers every variant.
+
+    :param filename: path of the image, used for the cache key
+    :param image: the loaded image
+    :param rects: list of (x, y, width, height) tuples
+    :param cache_dir: directory for the sidecar files, or None
+    :rtype: dict of rect: True if opaque, or None if masks are not available
+    """
+    cache_path = None
+    if cache_dir:
+        with open(filename, 'rb') as fh:
+            digest = hashlib.sha1(fh.read()).hexdigest()
+        cache_path = os.path.join(cache_dir, 'tiles', digest + '.json')
+        try:
+            with open(cache_path) as fh:
+                cached = json.load(fh)
+            found = {tuple(map(int, key.split(','))): value == 'opaque'
+                     for key, value in cached.items()}
+            if all(rect in found for rect in rects):
+                return found
+        except (OSError, ValueError):
+            pass
+
+    try:
+        mask = pygame.mask.from_surface(image, alpha_threshold)
+    except:
+        return None
+
+    found = dict()
+    filled = dict()
+    for rect in rects:
+        x, y, w, h = rect
+        if (w, h) not in filled:
+            filled[(w, h)] = pygame.mask.Mask((w, h), fill=True)
+        found[rect] = filled[(w, h)].overlap_area(mask, (-x, -y)) == w * h
+
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = '{0}.{1}.{2}'.format(cache_path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'w') as fh:
+            json.dump({','.join(map(str, rect)): 'opaque' if opaque else 'alpha'
+                       for rect, opaque in found.items()}, fh)
+        os.replace(temp_path, cache_path)
+
+    return found
+
+
 def pygame_image_loader(filename, colorkey, **kwargs):
     """ pytmx image loader for pygame
 
@@ -96,7 +227,15 @@ def pygame_image_loader(filename, colorkey, **kwargs):
         colorkey = pygame.Color('#{0}'.format(colorkey))
 
     pixelalpha = kwargs.get('pixelalpha', True)
-    image = pygame.image.load(filename)
+    cache_dir = kwargs.get('cache_dir')
+    image = load_image_file(filename, cache_dir=cache_dir)
+
+    # colorkeyed tiles are never checked for transparent pixels
+    opaque = dict()
+    if not colorkey:
+        tileset = kwargs.get('tileset')
+        rects = tileset.tile_rects() if tileset else [(0, 0) + image.get_size()]
+        opaque = classify_tiles(filename, image, rects, cache_dir) or dict()
 
     def load_image(rect=None, flags=None):
         if rect:
@@ -111,7 +250,8 @@ def pygame_image_loader(filename, colorkey, **kwargs):
         if flags:
             tile = handle_transformation(tile, flags)
 
-        tile = smart_convert(tile, colorkey, pixelalpha)
+        tile = smart_convert(tile, colorkey, pixelalpha,
+                             opaque.get(tuple(rect or (0, 0) + image.get_size())))
         return tile
 
     return load_image
@@ -187,7 +327,7 @@ def build_rects(tmxmap, layer, tileset=None, real_gid=None):
             raise ValueError
 
     if isinstance(layer, int):
-        layer_data = tmxmap.get_layer_data(layer)
+        layer_data = tmxmap.layers[layer].data
     elif isinstance(layer, str):
         try:
             layer = [l for l in tmxmap.layers if l.name == layer].pop()
@@ -197,13 +337,80 @@ def build_rects(tmxmap, layer, tileset=None, real_gid=None):
             logger.debug(msg.format(layer, tmxmap))
             raise ValueError
 
-    p = itertools.product(range(tmxmap.width), range(tmxmap.height))
-    if gid:
-        points = [(x, y) for (x, y) in p if layer_data[y][x] == gid]
-    else:
-        points = [(x, y) for (x, y) in p if layer_data[y][x]]
+    # one byte per tile, 1 where the tile is wanted
+    match = gid.__eq__ if gid else bool
+    tw, th = tmxmap.tilewidth, tmxmap.tileheight
+    if isinstance(layer_data, pytmx.ChunkedLayerData):
+        # rects are not merged across chunk edges
+        rects = list()
+        for cx, cy in sorted(layer_data.keys(), key=lambda key: (key[1], key[0])):
+            chunk = layer_data.chunk(cx, cy)
+            solid = bytearray(map(match, chunk.gids))
+            rects.extend(greedy_rects(solid, chunk.width, chunk.height, tw, th,
+                                      cx * chunk.width, cy * chunk.height))
+        return rects
+
+    solid = bytearray(map(match, layer_data.gids))
+    return greedy_rects(solid, layer_data.width, layer_data.height, tw, th)
+
+
+def greedy_rects(solid, width, height, tilewidth, tileheight, left=0, top=0):
+    """ Cover the set tiles of a grid with few non-overlapping rects
+
+    Greedy meshing: take the first set tile, extend it along the row as far
+    as it goes, then across the following rows while they are set for the
+    same span.  Merging row by row and column by column can give different
+    results, so both are done and the one with fewer rects is returned.
+
+    :param solid: bytearray of width * height in row order, 1 for set tiles
+    :param width: width of the grid in tiles
+    :param height: height of the grid in tiles
+    :param tilewidth: width of a tile in pixels
+    :param tileheight: height of a tile in pixels
+    :param left: tile x of the first column
+    :param top: tile y of the first row
+    :return: List of pygame Rect objects, in pixels
+    """
+    columns = bytearray(len(solid))
+    for x in range(width):
+        columns[x * height:(x + 1) * height] = solid[x::width]
+
+    rects = _greedy_pass(bytearray(solid), width, height)
+    by_columns = _greedy_pass(columns, height, width)
+    if len(by_columns) < len(rects):
+        rects = [(x, y, w, h) for y, x, h, w in by_columns]
+
+    return [pygame.Rect((left + x) * tilewidth, (top + y) * tileheight,
+                        w * tilewidth, h * tileheight) for x, y, w, h in rects]
+
+
+def _greedy_pass(solid, width, height):
+    # used tiles are cleared as rects are taken.  runs are found with
+    # bytearray.find and rows compared as slices, so each tile is only
+    # touched a few times, mostly in C
+    rects = list()
+    i = solid.find(1)
+    while i != -1:
+        y, x = divmod(i, width)
+        row_end = i - x + width
+        end = solid.find(0, i, row_end)
+        if end == -1:
+            end = row_end
+        run = end - i
+        full = solid[i:end]
+        empty = bytes(run)
+
+        solid[i:end] = empty
+        rows = 1
+        j = i + width
+        while y + rows < height and solid[j:j + run] == full:
+            solid[j:j + run] = empty
+            rows += 1
+            j += width
+
+        rects.append((x, y, run, rows))
+        i = solid.find(1, end)
 
-    rects = simplify(points, tmxmap.tilewidth, tmxmap.tileheight)
     return rects
 
 
@@ -248,47 +455,19 @@ def simplify(all_points, tilewidth, tileheight):
     there may be cases where the number of rectangles is not as low as possible,
     but I haven't found that it is excessively bad.  certainly much better than
     making a list of rects, one for each tile on the map!
-    """
-
-    def pick_rect(points, rects):
-        ox, oy = sorted([(sum(p), p) for p in points])[0][1]
-        x = ox
-        y = oy
-        ex = None
-
-        while 1:
-            x += 1
-            if not (x, y) in points:
-                if ex is None:
-                    ex = x - 1
-
-                if (ox, y + 1) in points:
-                    if x == ex + 1:
-                        y += 1
-                        x = ox
 
-                    else:
-                        y -= 1
-                        break
-                else:
-                    if x <= ex: y -= 1
-                    break
-
-        c_rect = pygame.Rect(ox * tilewidth, oy * tileheight,
-                             (ex - ox + 1) * tilewidth,
-                             (y - oy + 1) * tileheight)
-
-        rects.append(c_rect)
-
-        rect = pygame.Rect(ox, oy, ex - ox + 1, y - oy + 1)
-        kill = [p for p in points if rect.collidepoint(p)]
-        [points.remove(i) for i in kill]
+    the points are put in a grid and merged by greedy_rects.
+    """
 
-        if points:
-            pick_rect(points, rects)
+    if not all_points:
+        return list()
 
-    rect_list = []
-    while all_points:
-        pick_rect(all_points, rect_list)
+    xs = [x for x, y in all_points]
+    ys = [y for x, y in all_points]
+    left, top = min(xs), min(ys)
+    width, height = max(xs) - left + 1, max(ys) - top + 1
+    solid = bytearray(width * height)
+    for x, y in all_points:
+        solid[(y - top) * width + x - left] = 1
 
-    return rect_list
+    return greedy_rects(solid, width, height, tilewidth, tileheight, left, top)